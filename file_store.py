@@ -1,9 +1,22 @@
 import os
 import os.path
+import posixpath
 from django.conf import settings
 import shutil
+import errno
+import fcntl
+import tempfile
+import time
+import uuid
 import hashlib
+import gzip
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 
 class FileStoreLocations(object):
@@ -51,7 +64,11 @@ class FileStoreLocations(object):
         return rpath, sig
 
 
-def get_path_with_folders(path, group, object_kind = None, folder = None):
+def get_path_with_folders(path, group, object_kind = None, folder = None, create = True):
+    """
+    Works out the folder for group/kind/folder under path. The folder is made if
+    it doesn't exist unless create is False.
+    """
     if group:
         path = os.path.join(path,group)
 
@@ -61,16 +78,18 @@ def get_path_with_folders(path, group, object_kind = None, folder = None):
     if folder:
         path = os.path.join(path, folder)
 
-
-    insure_folder(path)
+    if create:
+        insure_folder(path)
     return path
 
 
-def get_object_folder_file_path(filename, object_group, object_kind, object_folder):
+def get_object_folder_file_path(filename, object_group, object_kind, object_folder, create = True):
     """
     Return a file path for filename and the given path folder.
+    This is the path of the plain file, files kept compressed (see FILE_COMPRESSION_RULES) are at this
+    path plus .gz or .zst. Read with open_object_folder_file if they might be.
     """
-    path = get_path_with_folders(settings.FILE_PERMANENT_DATA_ROOT, object_group, object_kind, object_folder)
+    path = get_path_with_folders(settings.FILE_PERMANENT_DATA_ROOT, object_group, object_kind, object_folder, create)
     jp= os.path.join(path, filename)
     return jp
 
@@ -78,23 +97,127 @@ def get_date_filename(prefix):
     n = datetime.now()
     return prefix + "_" + n.strftime("%y_%m_%d_%H_%M_%S")
 
-def path_exists(path, group, kind=None, folder=None):
+def resolve_signified_path(path, group, kind=None, folder=None, create=True):
+    """
+    Turn a path with a signifier like inbox:foo.txt into a file system path
+    With compression rules set an object folder file only stored compressed raises IOError rather
+    than giving a path that isn't there, open_object_folder_file reads those.
+    """
     path, sig = FileStoreLocations.split_path_and_signifier(path)
     if sig == FileStoreLocations.APP_INBOX:
-        path = get_inbox_file_path(path, group)
+        path = get_inbox_file_path(path, group, create)
     if sig == FileStoreLocations.FILE_SYSTEM:
         path = path
     if sig == FileStoreLocations.OBJECT_FOLDER:
-        path = get_object_folder_file_path(path, group, kind, folder)
+        path = get_object_folder_file_path(path, group, kind, folder, create)
+        if getattr(settings, 'FILE_COMPRESSION_RULES', None) and not os.path.exists(path):
+            for compression in COMPRESSORS:
+                if os.path.exists("%s.%s" % (path, compression)):
+                    raise IOError(errno.ENOENT, "Stored compressed, use open_object_folder_file", path)
+    if sig == FileStoreLocations.TEMP:
+        path = get_temp_file_path(path, group, create)
+    return path
+
+def path_exists(path, group, kind=None, folder=None):
+    rpath, sig = FileStoreLocations.split_path_and_signifier(path)
+    if sig == FileStoreLocations.CLOUD_STORAGE_S3:
+        from s3_store import s3_key_exists, get_s3_key
+        return s3_key_exists(get_s3_key(rpath, group, kind, folder))
+    if sig == FileStoreLocations.OBJECT_FOLDER:
+        return get_object_folder_stored_path(rpath, group, kind, folder)[0] is not None
+    return os.path.exists(resolve_signified_path(path, group, kind, folder, create=False))
+
+def _list_folder(dir_path):
+    if isinstance(dir_path, tuple):  # (signifier, prefix) for cloud storage
+        from s3_store import list_s3_folder
+        return list_s3_folder(dir_path[1])
+    try:
+        return set(os.listdir(dir_path or '.'))
+    except OSError:
+        return set()
+
+def paths_exist(paths, group, kind=None, folder=None):
+    """
+    Like path_exists for a list of paths. Folders holding several of them are listed once, the rest are stat'ed.
+    Returns a list of booleans in the same order as paths.
+    """
+    resolved = []
+    for x in paths:
+        rpath, sig = FileStoreLocations.split_path_and_signifier(x)
+        if sig == FileStoreLocations.CLOUD_STORAGE_S3:
+            from s3_store import get_s3_key
+            dir_path, name = posixpath.split(get_s3_key(rpath, group, kind, folder))
+            dir_path = (sig, dir_path)
+        elif sig == FileStoreLocations.OBJECT_FOLDER:
+            dir_path, name = os.path.split(get_object_folder_file_path(rpath, group, kind, folder, create=False))
+        else:
+            dir_path, name = os.path.split(resolve_signified_path(x, group, kind, folder, create=False))
+        # object folder files might be stored compressed
+        names = [name]
+        if sig == FileStoreLocations.OBJECT_FOLDER:
+            names.extend(["%s.%s" % (name, c) for c in COMPRESSORS])
+        resolved.append((dir_path, names))
+
+    # a stat is cheaper than listing a big folder for one name
+    counts = {}
+    for dir_path, names in resolved:
+        counts[dir_path] = counts.get(dir_path, 0) + 1
+
+    folder_contents = {}
+    exists = []
+    for dir_path, names in resolved:
+        if counts[dir_path] == 1 and not isinstance(dir_path, tuple):
+            exists.append(any(os.path.exists(os.path.join(dir_path, x)) for x in names))
+            continue
+        if dir_path not in folder_contents:
+            folder_contents[dir_path] = _list_folder(dir_path)
+        exists.append(any(x in folder_contents[dir_path] for x in names))
+    return exists
+
+
+#
+# Folders we know exist so we don't have to keep asking the file system.
+# Something outside might remove them, the writes here are wrapped with retry_on_missing_folder
+# which forgets any that have gone and tries again. Paths handed out are written by the caller so
+# call forget_folders if you remove folders yourself.
+#
+_known_folders = set()
 
-    return os.path.exists(path)
-    
-    
 def insure_folder(path):
+    if path in _known_folders:
+        return path
     if not os.path.exists(path):
-        os.makedirs(path, 0744)
+        try:
+            os.makedirs(path, 0744)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    _known_folders.add(path)
     return path
 
+def forget_folders():
+    _known_folders.clear()
+
+def _forget_missing_folders():
+    missing = [x for x in list(_known_folders) if not os.path.isdir(x)]
+    _known_folders.difference_update(missing)
+    return bool(missing)
+
+def retry_on_missing_folder(func):
+    """
+    If func fails with ENOENT because a folder insure_folder remembered has been removed
+    the folder is forgotten and func called once more, which makes it again.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT or not _forget_missing_folders():
+                raise
+        return func(*args, **kwargs)
+    return wrapper
+
 
 def check_extensions(x, elist):
     """
@@ -117,22 +240,131 @@ def switch_extension(filename, new_extension):
 def strip_extension(filename):
     return os.path.splitext(filename)[0]
 
-def get_inbox_file_list(group = None, extensions = None):
+#
+# Inbox listings are cached per folder and rescanned when the folder's mtime changes. A rescan only
+# stats names it hasn't seen. Files written in place (rsync, scp) don't change the folder's mtime so
+# every file is stat'ed again once the stats are INBOX_SNAPSHOT_MAX_AGE old, that's how long such a
+# file can keep its old place in the list.
+#
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# A folder changed within this many seconds of a scan could change again with the same mtime
+INBOX_MTIME_RESOLUTION = 2.0
+INBOX_SNAPSHOT_MAX_AGE = 10.0
+
+
+class InboxSnapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.stable = False
+        self.stated_on = 0
+        self.mtimes = {}
+        self.files = []
+        self.filtered = {}
+
+    def is_current(self, dir_mtime):
+        return (self.stable and dir_mtime == self.dir_mtime and
+                time.time() - self.stated_on < INBOX_SNAPSHOT_MAX_AGE)
+
+    def _scan_entries(self, known):
+        """
+        {name: mtime} for each file. Names in known keep their mtime, DirEntry.stat() saves a path
+        lookup for the rest
+        """
+        mtimes = {}
+        if scandir:
+            for x in scandir(self.path):
+                if x.name.startswith(UPLOAD_TEMP_PREFIX):
+                    continue
+                if x.name in known:
+                    mtimes[x.name] = known[x.name]
+                    continue
+                try:
+                    mtimes[x.name] = x.stat().st_mtime
+                except OSError:
+                    pass # removed since we listed it
+        else:
+            for name in os.listdir(self.path):
+                if name.startswith(UPLOAD_TEMP_PREFIX):
+                    continue
+                if name in known:
+                    mtimes[name] = known[name]
+                    continue
+                try:
+                    mtimes[name] = os.path.getmtime(os.path.join(self.path, name))
+                except OSError:
+                    pass
+        return mtimes
+
+    def refresh(self, dir_mtime):
+        now = time.time()
+        if now - self.stated_on < INBOX_SNAPSHOT_MAX_AGE:
+            mtimes = self._scan_entries(self.mtimes)
+        else:
+            mtimes = self._scan_entries({})
+            self.stated_on = now
+        self.mtimes = mtimes
+        self.files = [x[1] for x in sorted(((v, k) for k, v in mtimes.items()), reverse=True)]
+        self.filtered = {}
+        self.dir_mtime = dir_mtime
+        self.stable = now - dir_mtime > INBOX_MTIME_RESOLUTION
+
+    def get_files(self, dir_mtime, extensions=None):
+        with self.lock:
+            if not self.is_current(dir_mtime):
+                self.refresh(dir_mtime)
+            if not extensions:
+                return self.files
+            key = tuple(sorted(extensions))
+            if key not in self.filtered:
+                self.filtered[key] = [x for x in self.files if check_extensions(x, extensions)]
+            return self.filtered[key]
+
+
+_inbox_snapshots = {}
+# only guards _inbox_snapshots, each snapshot has its own lock for scanning
+_inbox_snapshots_lock = threading.Lock()
+
+def get_inbox_files(group = None, extensions = None):
+    path = get_path_with_folders(settings.FILE_INBOX_DATA_ROOT, group)
+    dir_mtime = os.path.getmtime(path)
+    with _inbox_snapshots_lock:
+        snapshot = _inbox_snapshots.get(path)
+        if not snapshot:
+            snapshot = _inbox_snapshots[path] = InboxSnapshot(path)
+    return snapshot.get_files(dir_mtime, extensions)
+
+
+def get_inbox_file_list(group = None, extensions = None, offset = 0, limit = None):
     """
     Abstracts looking for incoming files. for now just looks in a dir. Someday might look
     at S3/Cloudfiles etc.
+    Files are newest first. Use offset and limit to get a page of them.
     """
-    path = get_path_with_folders(settings.FILE_INBOX_DATA_ROOT, group)
-    files  =  sorted([(os.path.getmtime(os.path.join(path, x)), x) for x in os.listdir(path) if check_extensions(x, extensions)], reverse=True)
+    files = get_inbox_files(group, extensions)
+    if limit is None:
+        return files[offset:]
+    return files[offset:offset + limit]
+
 
-    return [x[1] for x in files]
+def get_inbox_file_count(group = None, extensions = None):
+    return len(get_inbox_files(group, extensions))
 
 
-def get_inbox_file_path(filename, group):
+def get_inbox_file_path(filename, group, create = True):
     """
     Return a file path for filename and the given path folder.
     """
-    path = get_path_with_folders(settings.FILE_INBOX_DATA_ROOT, group)
+    path = get_path_with_folders(settings.FILE_INBOX_DATA_ROOT, group, create = create)
     return os.path.join(path, filename)
 
 def get_file_size_for_path(pathname):
@@ -148,22 +380,135 @@ def humanize_file_size(size):
     elif size < 1024*1024*1024*1024:
         return "%4.2f GB" % (size/(1024.9*1024.0*1024.0))
 
-def get_sha256_digest_for_path(pathname):
-    f = open(pathname, 'rb')
+#
+# Digests are expensive for big files so they are cached against the file's identity.
+# If settings.FILE_DIGEST_CACHE_PATH is set the cache is kept in a sqlite file there
+# otherwise it only lives as long as the process.
+#
+DIGEST_READ_SIZE = 1024*1024
+DIGEST_SMALL_READ_SIZE = 64*1024
+DIGEST_THREAD_COUNT = 4
+DIGEST_CACHE_SIZE = 100000
+
+
+class DigestCache(object):
+    """
+    The digests in memory are kept to the size most recently used, the sqlite file has them all
+    """
+
+    def __init__(self, file_path=None, size=DIGEST_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.digests = OrderedDict()
+        self.db = None
+        if file_path:
+            insure_folder(os.path.dirname(file_path))
+            self.db = sqlite3.connect(file_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS DIGEST(dev INT, ino INT, size INT, mtime REAL, digest TEXT, "
+                            "PRIMARY KEY (dev, ino));")
+            self.db.commit()
+
+    def _remember(self, key, digest):
+        self.digests[key] = digest
+        while len(self.digests) > self.size:
+            self.digests.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            digest = self.digests.pop(key, None)
+            if digest is not None:
+                self.digests[key] = digest  # now the most recently used
+                return digest
+            if self.db:
+                row = self.db.execute("SELECT digest FROM DIGEST WHERE dev=? AND ino=? AND size=? AND mtime=?",
+                                      key).fetchone()
+                if row:
+                    self._remember(key, str(row[0]))
+                    return self.digests[key]
+        return None
+
+    def set(self, key, digest):
+        with self.lock:
+            self.digests.pop(key, None)
+            self._remember(key, digest)
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO DIGEST(dev, ino, size, mtime, digest) VALUES (?,?,?,?,?)",
+                                key + (digest,))
+                self.db.commit()
+
+_digest_cache = None
+_digest_cache_lock = threading.Lock()
+
+def get_digest_cache():
+    global _digest_cache
+    with _digest_cache_lock:
+        if _digest_cache is None:
+            _digest_cache = DigestCache(getattr(settings, 'FILE_DIGEST_CACHE_PATH', None))
+    return _digest_cache
+
+
+def get_digest_key_for_path(pathname):
+    """
+    The cache key for a file's digest. If any of these change the file has to be read again.
+    """
+    st = os.stat(pathname)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime
+
+
+def _compute_sha256_digest_for_path(pathname, size):
     digest = hashlib.sha256()
-    endOfFile = False
-    while not endOfFile:
-        bytes = f.read(8192)
-        digest.update(bytes)
-        endOfFile = len(bytes) != 8192
+    # Big reads let hashlib drop the GIL for longer and cut the number of syscalls
+    read_size = DIGEST_READ_SIZE if size > DIGEST_READ_SIZE else DIGEST_SMALL_READ_SIZE
+    f = open(pathname, 'rb')
+    try:
+        while True:
+            bytes = f.read(read_size)
+            if not bytes:
+                break
+            digest.update(bytes)
+    finally:
+        f.close()
 
     return digest.hexdigest()
 
 
+def get_sha256_digest_for_path(pathname, use_cache=True):
+    if not use_cache:
+        return _compute_sha256_digest_for_path(pathname, get_file_size_for_path(pathname))
+
+    key = get_digest_key_for_path(pathname)
+    cache = get_digest_cache()
+    digest = cache.get(key)
+    if digest is None:
+        digest = _compute_sha256_digest_for_path(pathname, key[2])
+        cache.set(key, digest)
+    return digest
+
+
+def get_sha256_digests_for_paths(pathnames, use_cache=True, thread_count=DIGEST_THREAD_COUNT):
+    """
+    Digest a list of files at once. Returns a dict of pathname -> digest.
+    The files are read in a pool of threads since hashlib releases the GIL while it works.
+    """
+    pathnames = list(pathnames)
+    if len(pathnames) < 2 or thread_count < 2:
+        return dict((x, get_sha256_digest_for_path(x, use_cache)) for x in pathnames)
+
+    pool = ThreadPool(min(thread_count, len(pathnames)))
+    try:
+        digests = pool.map(lambda x: get_sha256_digest_for_path(x, use_cache), pathnames)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(pathnames, digests))
+
+
 def remove_file_from_inbox(filename, group):
     os.remove(get_inbox_file_path(filename, group))
 
 
+@retry_on_missing_folder
 def insure_file_in_object_folder(filename, signifier, group, kind, folder):
     """
     Copy a file from the  to the permanent storage location
@@ -177,19 +522,639 @@ def insure_file_in_object_folder(filename, signifier, group, kind, folder):
 
     elif signifier == FileStoreLocations.APP_INBOX:
         src =  get_inbox_file_path(filename, group)
+    elif signifier == FileStoreLocations.CLOUD_STORAGE_S3:
+        from s3_store import get_s3_file_local_path, get_s3_key
+        src = get_s3_file_local_path(get_s3_key(filename, group, kind, folder))
     else:
         assert 0, "File store location (%s) not supported" % (FileStoreLocations.SIGNIFIERS.get(signifier,"Unknown"))
 
     dest = get_object_folder_file_path(filename, group, kind, folder)
-    shutil.copy(src, dest)
+    compression = get_compression_for_filename(filename)
+    if compression:
+        # compress_file shares the compressed copy through the content store when there is one
+        compress_file(src, dest, compression)
+    elif get_content_store_root():
+        link_file_from_content_store(src, dest)
+    else:
+        # dest might be a link shared with other objects so it is replaced rather than written over
+        _remove_if_exists(dest)
+        shutil.copy(src, dest)
+
+
+#
+# Content addressed storage.
+# If settings.FILE_CONTENT_STORE_ROOT is set each distinct file is kept once under its sha256 digest
+# and object folder paths are hard links to it. The link count of a stored file is its reference count
+# so anything left with only the store's own link can be garbage collected.
+# Stored files are read only since writing to one would change every object linking to it, object
+# folder files are always replaced rather than written over.
+# The store should be on the same file system as FILE_PERMANENT_DATA_ROOT or we fall back to
+# reflinks (where the file system supports them) and then plain copies.
+#
+FICLONE = 0x40049409  # from linux/fs.h
+CONTENT_STORE_TEMP_AGE = 24*60*60
+CONTENT_STORE_GRACE_AGE = 60*60
+STORED_FILE_MODE = 0o444
+
+
+def get_content_store_root():
+    return getattr(settings, 'FILE_CONTENT_STORE_ROOT', None)
+
+
+def get_content_store_path(digest):
+    return os.path.join(get_content_store_root(), digest[0:2], digest[2:4], digest)
+
+
+def get_content_reference_count(digest):
+    """
+    How many object folder paths share the stored file for digest
+    """
+    try:
+        return os.stat(get_content_store_path(digest)).st_nlink - 1
+    except OSError:
+        return 0
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _clone_or_copy_file(src, dest):
+    """
+    Try for a copy on write clone of src and do a real copy if the file system can't.
+    An existing dest is removed first, not written over.
+    """
+    _remove_if_exists(dest)
+    src_f = open(src, 'rb')
+    dest_f = open(dest, 'wb')
+    try:
+        try:
+            fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+        except IOError:
+            shutil.copyfileobj(src_f, dest_f, DIGEST_READ_SIZE)
+    finally:
+        src_f.close()
+        dest_f.close()
+    shutil.copymode(src, dest)
+
+
+@retry_on_missing_folder
+def insure_file_in_content_store(src, move=False):
+    """
+    Make sure the content of src is in the content store and return its digest.
+    Nothing is copied if the same content is already there.
+    With move src is renamed into the store if it can be (and left alone if the content is already stored)
+    """
+    digest = get_sha256_digest_for_path(src)
+    store_path = get_content_store_path(digest)
+    if not os.path.exists(store_path):
+        folder = insure_folder(os.path.dirname(store_path))
+        if move:
+            try:
+                os.rename(src, store_path)
+                os.chmod(store_path, STORED_FILE_MODE)
+                return digest
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp')
+        os.close(fd)
+        try:
+            _clone_or_copy_file(src, tmp_path)
+            os.chmod(tmp_path, STORED_FILE_MODE)
+            os.rename(tmp_path, store_path)
+        except:
+            os.remove(tmp_path)
+            raise
+    return digest
+
+
+def _link_stored_file(store_path, dest):
+    """
+    Hard link a stored file to dest, cloning or copying when the file systems won't allow a link
+    """
+    if os.path.exists(dest):
+        if os.path.samefile(store_path, dest):
+            return dest
+        os.remove(dest)
+
+    try:
+        os.link(store_path, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        _clone_or_copy_file(store_path, dest)
+    return dest
+
+
+def link_file_from_content_store(src, dest, move=False):
+    """
+    Put the content of src at dest sharing the stored copy where we can
+    """
+    try:
+        return _link_stored_file(get_content_store_path(insure_file_in_content_store(src, move)), dest)
+    except (OSError, IOError) as e:
+        if e.errno != errno.ENOENT or not os.path.exists(src):
+            raise
+    # the stored copy was garbage collected between finding it and linking to it so store it again
+    return _link_stored_file(get_content_store_path(insure_file_in_content_store(src, move)), dest)
+
+
+def collect_content_store_garbage(dry_run=False, min_age=CONTENT_STORE_GRACE_AGE):
+    """
+    Remove stored files which no object folder links to any more.
+    Files whose links changed in the last min_age seconds are left for next time as they may
+    have just been stored and not linked yet.
+    Returns the number of files and bytes freed
+    """
+    root = get_content_store_root()
+    count = 0
+    size = 0
+    if not root or not os.path.exists(root):
+        return count, size
+
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            st = os.lstat(path)
+            if st.st_nlink > 1 or time.time() - st.st_ctime < min_age:
+                continue
+            # temp files are garbage too once they are too old to belong to a copy in progress
+            if name.startswith('.tmp') and time.time() - st.st_mtime < CONTENT_STORE_TEMP_AGE:
+                continue
+            count += 1
+            size += st.st_size
+            if not dry_run:
+                os.remove(path)
+
+    return count, size
+
+
+#
+# Compressed storage for object folders.
+# settings.FILE_COMPRESSION_RULES maps a compression to the extensions it is used for like
+# {'gz': ['txt', 'csv']}. Matching files are stored as filename.gz and open_object_folder_file
+# hands back a reader which decompresses as it goes so callers don't need to know.
+# zstd ('zst') needs the zstandard package.
+#
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_LEVELS = dict(gz=6, zst=3)
+
+
+def _open_gzip(path, mode):
+    return gzip.GzipFile(path, mode, compresslevel=COMPRESSION_LEVELS['gz'])
+
+def _open_zstd(path, mode):
+    f = open(path, mode)
+    if 'r' in mode:
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    return zstandard.ZstdCompressor(level=COMPRESSION_LEVELS['zst']).stream_writer(f)
+
+COMPRESSORS = dict(gz=_open_gzip)
+if zstandard:
+    COMPRESSORS['zst'] = _open_zstd
+
+
+def get_compression_for_filename(filename):
+    rules = getattr(settings, 'FILE_COMPRESSION_RULES', None) or {}
+    for compression, extensions in rules.items():
+        if extensions and compression in COMPRESSORS and check_extensions(filename, extensions):
+            return compression
+    return None
+
+
+def _link_compressed_file(tmp_path, digest, compression, stored_path):
+    """
+    Link stored_path to the content store's copy of a compressed file, digest.compression, moving
+    tmp_path in there if it isn't stored yet. digest is that of the uncompressed data so the same
+    content compressed the same way is only kept once.
+    """
+    store_path = "%s.%s" % (get_content_store_path(digest), compression)
+    if os.path.exists(store_path):
+        try:
+            _link_stored_file(store_path, stored_path)
+            os.remove(tmp_path)
+            return stored_path
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # garbage collected since we looked, store ours instead
+
+    folder = insure_folder(os.path.dirname(store_path))
+    os.chmod(tmp_path, STORED_FILE_MODE)
+    try:
+        os.rename(tmp_path, store_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        fd, store_tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp')
+        os.close(fd)
+        try:
+            _clone_or_copy_file(tmp_path, store_tmp_path)
+            os.rename(store_tmp_path, store_path)
+        except:
+            os.remove(store_tmp_path)
+            raise
+        finally:
+            os.remove(tmp_path)
+    return _link_stored_file(store_path, stored_path)
+
+
+def compress_file(src, dest, compression):
+    """
+    Stream src into dest.compression. Returns the sha256 digest of the uncompressed data.
+    With a content store the compressed file is kept there and dest.compression links to it.
+    Any other stored version of dest is removed.
+    """
+    digest = hashlib.sha256()
+    stored_path = "%s.%s" % (dest, compression)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp')
+    os.close(fd)
+    try:
+        src_f = open(src, 'rb')
+        dest_f = COMPRESSORS[compression](tmp_path, 'wb')
+        try:
+            while True:
+                bytes = src_f.read(DIGEST_READ_SIZE)
+                if not bytes:
+                    break
+                digest.update(bytes)
+                dest_f.write(bytes)
+        finally:
+            src_f.close()
+            dest_f.close()
+        shutil.copymode(src, tmp_path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    if get_content_store_root():
+        _link_compressed_file(tmp_path, digest.hexdigest(), compression, stored_path)
+    else:
+        os.rename(tmp_path, stored_path)
+
+    for path in [dest] + ["%s.%s" % (dest, c) for c in COMPRESSORS if c != compression]:
+        if os.path.exists(path):
+            os.remove(path)
+    return digest.hexdigest()
+
+
+def get_object_folder_stored_path(filename, group, kind, folder):
+    """
+    Where an object folder file really is. Returns (path, compression) with a compression
+    of None for plain files or (None, None) if it isn't there at all.
+    """
+    path = get_object_folder_file_path(filename, group, kind, folder, create=False)
+    if os.path.exists(path):
+        return path, None
+    for compression in COMPRESSORS:
+        stored_path = "%s.%s" % (path, compression)
+        if os.path.exists(stored_path):
+            return stored_path, compression
+    return None, None
+
+
+def open_object_folder_file(filename, group, kind, folder):
+    """
+    Open an object folder file for reading whether or not it is stored compressed
+    """
+    path, compression = get_object_folder_stored_path(filename, group, kind, folder)
+    if path is None:
+        raise IOError(errno.ENOENT, "No such object folder file", filename)
+    if compression:
+        return COMPRESSORS[compression](path, 'rb')
+    return open(path, 'rb')
+
+
+#
+# Bulk ingestion of inbox files into an object folder.
+# Files are moved a few at a time. A rename is used when the inbox and object folder are on the
+# same file system, otherwise the data is cloned or copied and the copy is checked against the digest.
+#
+INGEST_THREAD_COUNT = 4
+
+
+@retry_on_missing_folder
+def ingest_inbox_file(filename, group, kind, folder, verify=True, remove_from_inbox=True):
+    """
+    Move (or copy if not remove_from_inbox) one inbox file into an object folder.
+    Returns the digest of the file if it was worked out
+    """
+    src = get_inbox_file_path(filename, group)
+    dest = get_object_folder_file_path(filename, group, kind, folder)
+    src_inode = os.stat(src).st_ino
+    digest = get_sha256_digest_for_path(src) if verify else None
+
+    compression = get_compression_for_filename(filename)
+    if compression:
+        compressed_digest = compress_file(src, dest, compression)
+        if verify and compressed_digest != digest:
+            os.remove("%s.%s" % (dest, compression))
+            raise IOError("Digest of %s changed while compressing it" % src)
+        if remove_from_inbox:
+            os.remove(src)
+        return compressed_digest
+
+    if get_content_store_root():
+        link_file_from_content_store(src, dest, move=remove_from_inbox)
+    elif remove_from_inbox:
+        try:
+            os.rename(src, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            _clone_or_copy_file(src, dest)
+    else:
+        _clone_or_copy_file(src, dest)
+
+    # A rename or link can't have changed the data, anything else gets checked
+    if verify and os.stat(dest).st_ino != src_inode:
+        if get_sha256_digest_for_path(dest, use_cache=False) != digest:
+            os.remove(dest)
+            raise IOError("Digest of %s does not match after copying it to %s" % (src, dest))
+
+    if remove_from_inbox and os.path.exists(src):
+        os.remove(src)
+    return digest
+
+
+def ingest_inbox_files(filenames, group, kind, folder, verify=True, remove_from_inbox=True,
+                       thread_count=INGEST_THREAD_COUNT, progress=None):
+    """
+    Ingest a batch of inbox files into an object folder using a pool of threads.
+    progress is called with (done, total, result) as each file finishes.
+    Returns a list of dicts with filename, digest and error (None if it worked) in the order of filenames.
+    A failure with one file doesn't stop the others.
+    """
+    filenames = list(filenames)
+
+    def ingest(indexed):
+        index, filename = indexed
+        try:
+            digest = ingest_inbox_file(filename, group, kind, folder, verify, remove_from_inbox)
+            return index, dict(filename=filename, digest=digest, error=None)
+        except (IOError, OSError) as e:
+            return index, dict(filename=filename, digest=None, error=str(e))
+
+    # by position so a name given twice still gets a result each time
+    results = [None] * len(filenames)
+    done = 0
+    pool = ThreadPool(max(1, min(thread_count, len(filenames))))
+    try:
+        for index, result in pool.imap_unordered(ingest, enumerate(filenames)):
+            results[index] = result
+            done += 1
+            if progress:
+                progress(done, len(filenames), result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+#
+# Temp storage.
+# Scratch files go under settings.FILE_TEMP_DATA_ROOT/group. Each group is kept under a byte quota
+# (settings.FILE_TEMP_QUOTAS[group] or FILE_TEMP_DEFAULT_QUOTA) by removing the least recently used
+# files. Small files can go on a tmpfs (settings.FILE_TEMP_TMPFS_ROOT) which has its own quota.
+#
+TEMP_DEFAULT_QUOTA = 10*1024*1024*1024
+TEMP_TMPFS_MAX_SIZE = 4*1024*1024
+TEMP_TMPFS_QUOTA = 256*1024*1024
+
+# while a path is handed out by temp_file it holds an flock on a lock file next to it so
+# enforce_temp_quota in any process leaves it alone
+TEMP_LOCK_PREFIX = '.lock-'
+
+
+def _get_temp_lock_path(file_path):
+    folder, name = os.path.split(file_path)
+    return os.path.join(folder, TEMP_LOCK_PREFIX + name)
+
+
+def _lock_temp_file(file_path, blocking=True):
+    """
+    Take the lock for a temp file. Returns the open lock file's descriptor or None if someone
+    else has it and not blocking
+    """
+    lock_path = _get_temp_lock_path(file_path)
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        # the lock file may have been removed by whoever had it before us, then we have to lock the new one
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except OSError:
+            pass
+        os.close(fd)
+
+
+def _unlock_temp_file(file_path, fd):
+    try:
+        os.remove(_get_temp_lock_path(file_path))
+    except OSError:
+        pass
+    os.close(fd)
+
+
+def get_temp_root(tmpfs=False):
+    if tmpfs:
+        return getattr(settings, 'FILE_TEMP_TMPFS_ROOT', None)
+    return getattr(settings, 'FILE_TEMP_DATA_ROOT', None) or os.path.join(tempfile.gettempdir(), 'dj_extras')
+
+
+def get_temp_quota(group, tmpfs=False):
+    if tmpfs:
+        return getattr(settings, 'FILE_TEMP_TMPFS_QUOTA', TEMP_TMPFS_QUOTA)
+    quotas = getattr(settings, 'FILE_TEMP_QUOTAS', None) or {}
+    return quotas.get(group, getattr(settings, 'FILE_TEMP_DEFAULT_QUOTA', TEMP_DEFAULT_QUOTA))
+
+
+def _check_temp_file_name(name, path):
+    """
+    Temp files go straight in their group's folder so names with folders (or ..) are refused
+    """
+    if name in ('', '.', '..') or os.path.basename(name) != name or '/' in name:
+        raise ValueError("Temp file names can't have folders: %s" % path)
+
+
+def get_temp_file_path(filename, group, create=True):
+    """
+    Return a file path for filename in the temp storage. Files already on the tmpfs are found there.
+    """
+    _check_temp_file_name(filename, filename)
+    if get_temp_root(tmpfs=True):
+        path = os.path.join(get_path_with_folders(get_temp_root(tmpfs=True), group, create=False), filename)
+        if os.path.exists(path):
+            return path
+    path = get_path_with_folders(get_temp_root(), group, create=create)
+    return os.path.join(path, filename)
+
+
+def enforce_temp_quota(group, reserve=0, tmpfs=False):
+    """
+    Remove the least recently used temp files of group until there is room for reserve more bytes.
+    Files handed out by temp_file (in any process) are left alone. Returns the number of bytes freed.
+    """
+    path = get_path_with_folders(get_temp_root(tmpfs), group, create=False)
+    if not os.path.exists(path):
+        return 0
+
+    files = []
+    total = 0
+    for name in os.listdir(path):
+        if name.startswith(TEMP_LOCK_PREFIX):
+            continue
+        file_path = os.path.join(path, name)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        total += st.st_size
+        # access times aren't updated on noatime mounts so the mtime counts as a use too
+        files.append((max(st.st_atime, st.st_mtime), st.st_size, file_path))
+
+    quota = get_temp_quota(group, tmpfs)
+    freed = 0
+    if total + reserve <= quota:
+        return freed
+
+    for used, size, file_path in sorted(files):
+        if total + reserve - freed <= quota:
+            break
+        fd = _lock_temp_file(file_path, blocking=False)
+        if fd is None:
+            continue  # in use
+        try:
+            os.remove(file_path)
+            freed += size
+        except OSError:
+            pass
+        finally:
+            _unlock_temp_file(file_path, fd)
+    return freed
+
+
+@contextmanager
+def temp_file(path=None, group=None, size_hint=None, keep=False):
+    """
+    Context manager giving the file system path for a scratch file.
+    path can be tmp:name or just name (a unique name is made if it is None). The name can't have
+    folders in it so it always ends up in the group's temp folder.
+    If size_hint is small enough the file goes on the tmpfs if there is one.
+    Room is made for size_hint bytes under the group's quota before the path is handed out.
+    The file is removed afterwards unless keep in which case it is left for the quota to clean up.
+
+        with temp_file('tmp:sorted.bed', 'lab', size_hint=1000) as path:
+            ...
+    """
+    if path is None:
+        path = "%s.tmp" % uuid.uuid4().hex
+    name, sig = FileStoreLocations.split_path_and_signifier(path)
+    if ':' in path and sig != FileStoreLocations.TEMP:
+        raise ValueError("Not a temp file path: %s" % path)
+    _check_temp_file_name(name, path)
+
+    tmpfs = bool(get_temp_root(tmpfs=True)) and size_hint is not None and size_hint <= TEMP_TMPFS_MAX_SIZE
+    enforce_temp_quota(group, reserve=size_hint or 0, tmpfs=tmpfs)
+    file_path = os.path.join(get_path_with_folders(get_temp_root(tmpfs), group), name)
+
+    lock_fd = _lock_temp_file(file_path)
+    try:
+        yield file_path
+    finally:
+        try:
+            if os.path.exists(file_path):
+                if keep:
+                    os.utime(file_path, None)
+                else:
+                    os.remove(file_path)
+        finally:
+            _unlock_temp_file(file_path, lock_fd)
+
+
+#
+# Uploads are written to a temp file next to the final one and renamed into place when complete
+# so nobody sees half written files. The temp files are left out of inbox listings.
+#
+UPLOAD_TEMP_PREFIX = '.upload-'
+
+
+def _open_upload_temp_file(path):
+    folder = os.path.dirname(path)
+    while True:
+        tmp_path = os.path.join(folder, UPLOAD_TEMP_PREFIX + uuid.uuid4().hex)
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        return tmp_path, os.fdopen(fd, 'wb')
+
+
+@retry_on_missing_folder
+def store_django_file_upload(f, group, fsync=None):
+    """
+    Writes an uploaded django file into the inbox working out its digest and size as it goes.
+    Returns a dict with the name, path, digest and size of the stored file.
+    If fsync (default settings.FILE_UPLOAD_FSYNC) the file is flushed to disk before it appears.
+    """
+    if fsync is None:
+        fsync = getattr(settings, 'FILE_UPLOAD_FSYNC', False)
+
+    path = get_inbox_file_path(f.name, group)
+    tmp_path, f_obj = _open_upload_temp_file(path)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        try:
+            for chunk in f.chunks():
+                digest.update(chunk)
+                size += len(chunk)
+                f_obj.write(chunk)
+            if fsync:
+                f_obj.flush()
+                os.fsync(f_obj.fileno())
+        finally:
+            f_obj.close()
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    if fsync:
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    digest = digest.hexdigest()
+    # Save reading the file again when someone asks for its digest
+    get_digest_cache().set(get_digest_key_for_path(path), digest)
+
+    return dict(name=f.name, path=path, digest=digest, size=size)
 
 
 def handle_django_file_upload(f, group):
     """
     Handles the uploading of a file from a django form fileField
     """
-    f_obj = open(get_inbox_file_path(f.name, group), "wb")
-    for chunk in f.chunks():
-        f_obj.write(chunk)
-    f_obj.close()
-    return f.name
\ No newline at end of file
+    return store_django_file_upload(f, group)['name']
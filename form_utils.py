@@ -1,6 +1,8 @@
+from django import forms
+
 import models
 
-from forms import create_form_field_with_parameter
+from forms import create_form_field_with_parameter, form_class_cache, freeze_for_key
 from forms import PercentageWidget, PositiveIntegerField, MaxValueValidator, MinValueValidator, PositiveIntegerWidget
 
 
@@ -33,15 +35,25 @@ def custom_formfield_callback(f, **kwargs):
 
 
 def create_form_class_with_parameter_list(param_list, name='dynform'):
+    """
+    The same parameter list gives back the same (cached) class
+    """
+    def build():
+        field_dict = {}
 
-    field_dict = {}
+        for x in param_list:
+            field = create_form_field_with_parameter(x)
+            if field:
+                field_dict[x['name']] = field
 
-    for x in param_list:
-        field = create_form_field_with_parameter(x)
-        if field:
-            field_dict[x['name']] = field
+        return type(name, (forms.BaseForm,), dict(base_fields=field_dict, formfield_callback = custom_formfield_callback ))
 
-    return type(name, (forms.BaseForm,), dict(base_fields=field_dict, formfield_callback = custom_formfield_callback ))
+    try:
+        key = ('parameters', name, freeze_for_key(param_list))
+        hash(key)
+    except TypeError:
+        return build()  # something in the list we can't make a key from
+    return form_class_cache.get(key, build)
 
 
 def create_form_with_parameter_list(param_list, name='dynform', initial_dict={}):
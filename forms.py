@@ -5,6 +5,8 @@ from django.core.validators import MaxValueValidator, MinValueValidator
 from django import forms
 
 import datetime
+import threading
+from collections import OrderedDict
 
 
 class PositiveIntegerWidget(TextInput):
@@ -164,19 +166,75 @@ def angular_formfield_callback(f, **kwargs):
     return field
 
 
+#
+# Building form classes on the fly is slow (the metaclass walks all the fields) so the classes are kept
+# in a small LRU cache. It's safe to share them since every form deep copies base_fields for itself.
+#
+FORM_CLASS_CACHE_SIZE = 200
+
+
+class FormClassCache(object):
+
+    def __init__(self, size=FORM_CLASS_CACHE_SIZE):
+        self.size = size
+        self.classes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        The class for key, calling build() to make it if it isn't in the cache
+        """
+        with self.lock:
+            form_class = self.classes.pop(key, None)
+            if form_class is not None:
+                self.classes[key] = form_class  # now the most recently used
+                return form_class
+
+        form_class = build()
+        with self.lock:
+            self.classes[key] = form_class
+            while len(self.classes) > self.size:
+                self.classes.popitem(last=False)
+        return form_class
+
+    def clear(self):
+        with self.lock:
+            self.classes.clear()
+
+
+form_class_cache = FormClassCache()
+
+
+def freeze_for_key(value):
+    """
+    Turn dicts and lists (like parameter lists) into nested tuples so they can be used as a cache key
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_for_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_for_key(x) for x in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(freeze_for_key(x) for x in value))
+    return value
+
+
 def get_form_class_for_class(klass):
     """
     A helper function for creating a model form class for a model on the fly. This is used with models (usually
     part of an inheritance hierarchy) which define a function **get_editable_fields** which returns an iterable
     of the field names which should be placed in the form.
     """
-    meta_dict = dict(model=klass)
-    if hasattr(klass, 'get_editable_fields'):
-        meta_dict['fields'] = klass.get_editable_fields()
+    fields = tuple(klass.get_editable_fields()) if hasattr(klass, 'get_editable_fields') else None
+
+    def build():
+        meta_dict = dict(model=klass)
+        if fields is not None:
+            meta_dict['fields'] = fields
+
+        meta = type('Meta', (),meta_dict)
+        return type('modelform', (forms.ModelForm,), {"Meta": meta})
 
-    meta = type('Meta', (),meta_dict)
-    modelform_class = type('modelform', (forms.ModelForm,), {"Meta": meta})
-    return modelform_class
+    return form_class_cache.get(('model', klass, fields), build)
 
 
 # Stuff using the ParameterTypes follows
@@ -0,0 +1,199 @@
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, connections, router
+from django.utils.encoding import force_text
+
+import os
+import os.path
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+
+#
+# Old rows of HistoryTrack models are moved out of the database into gzipped files of json lines under
+# settings.HISTORY_ARCHIVE_ROOT/app_label.model_name/. Rows are put in one of ARCHIVE_BUCKETS files by a
+# hash of the id of the object they are the history of (so any kind of pk works). Each archiving run writes an object's rows as a gzip member
+# of their own and notes where it is in the bucket's index file, so reading one object's history only
+# decompresses that object's members rather than the whole bucket. Appends to a bucket hold a lock
+# on its index file so runs at the same time don't mix up their members.
+# The latest row for each object always stays in the table.
+#
+ARCHIVE_BUCKETS = 256
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def get_archive_root():
+    return getattr(settings, 'HISTORY_ARCHIVE_ROOT', None)
+
+
+def get_archive_folder(model):
+    return os.path.join(get_archive_root(), "%s.%s" % (model._meta.app_label, model._meta.model_name))
+
+
+def _get_parent_key(parent_id):
+    return force_text(parent_id)
+
+
+def _get_bucket(parent_id):
+    return int(hashlib.md5(_get_parent_key(parent_id).encode('utf-8')).hexdigest(), 16) % ARCHIVE_BUCKETS
+
+
+def get_archive_path(model, parent_id):
+    return os.path.join(get_archive_folder(model), "%03d.jsonl.gz" % _get_bucket(parent_id))
+
+
+def get_archive_index_path(model, parent_id):
+    return os.path.join(get_archive_folder(model), "%03d.idx" % _get_bucket(parent_id))
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _get_parent_field(model):
+    name = getattr(model, 'history_parent_field', None)
+    assert name, "%s needs a history_parent_field to be archived" % model.__name__
+    return model._meta.get_field(name)
+
+
+def _write_archive_rows(model, rows, parent_field):
+    by_path = {}
+    for row in serializers.serialize('python', rows):
+        parent_id = row['fields'][parent_field.name]
+        paths = (get_archive_path(model, parent_id), get_archive_index_path(model, parent_id))
+        by_path.setdefault(paths, {}).setdefault(parent_id, []).append(row)
+
+    folder = get_archive_folder(model)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    for (path, index_path), by_parent in by_path.items():
+        index_f = open(index_path, 'ab')
+        try:
+            # other runs wait so the offsets we note are where our members really went
+            fcntl.flock(index_f.fileno(), fcntl.LOCK_EX)
+            index_lines = []
+            f = open(path, 'ab')
+            try:
+                f.seek(0, os.SEEK_END)
+                for parent_id, parent_rows in sorted(by_parent.items()):
+                    # each object's rows are a gzip member of their own so they can be read without the rest
+                    start = f.tell()
+                    member = gzip.GzipFile(fileobj=f, mode='wb')
+                    for row in parent_rows:
+                        member.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+                    member.close()
+                    index_lines.append("%s %d %d\n" % (_get_parent_key(parent_id), start, f.tell() - start))
+            finally:
+                f.close()
+            # make sure it is really on disk before the index points at it and the rows are deleted
+            _fsync_path(path)
+
+            index_f.write("".join(index_lines).encode('utf-8'))
+            index_f.flush()
+            os.fsync(index_f.fileno())
+        finally:
+            index_f.close()  # which drops the lock
+
+
+def archive_history(model, before, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move the rows of model changed before the datetime before into the archive, except for the latest
+    row of each parent. Returns the number of rows moved.
+    """
+    assert get_archive_root(), "settings.HISTORY_ARCHIVE_ROOT is needed to archive history"
+    parent_field = _get_parent_field(model)
+    opts = model._meta
+    qn = connections[router.db_for_write(model)].ops.quote_name
+    sql_info = dict(table=qn(opts.db_table),
+                    fk=qn(parent_field.column),
+                    changed_on=qn(opts.get_field('changed_on').column))
+    not_latest_clause = ("%(table)s.%(changed_on)s < (SELECT MAX(h2.%(changed_on)s) FROM %(table)s h2 "
+                         "WHERE h2.%(fk)s = %(table)s.%(fk)s)" % sql_info)
+
+    count = 0
+    last_pk = None
+    while True:
+        qs = model.objects.filter(changed_on__lt=before).extra(where=[not_latest_clause]).order_by('pk')
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        rows = list(qs[0:batch_size])
+        if not rows:
+            break
+
+        _write_archive_rows(model, rows, parent_field)
+        with transaction.atomic(using=router.db_for_write(model)):
+            model.objects.filter(pk__in=[x.pk for x in rows]).delete()
+        count += len(rows)
+        last_pk = rows[-1].pk
+
+    return count
+
+
+def _get_archive_members(model, parent_id):
+    """
+    (start, length) of each member of the bucket file holding rows for parent_id
+    """
+    index_path = get_archive_index_path(model, parent_id)
+    if not os.path.exists(index_path):
+        return []
+    key = _get_parent_key(parent_id)
+    members = []
+    with open(index_path, 'rb') as f:
+        # shared so a run appending to it can't leave us half a line
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        for line in f:
+            parts = line.decode('utf-8').rsplit(None, 2)
+            if len(parts) == 3 and parts[0] == key:
+                members.append((int(parts[1]), int(parts[2])))
+    return members
+
+
+def read_archived_history(model, parent_id):
+    """
+    The archived rows for parent_id as (unsaved) model instances
+    """
+    if not get_archive_root():
+        return []
+    members = _get_archive_members(model, parent_id)
+    if not members:
+        return []
+
+    parent_field = _get_parent_field(model)
+    key = _get_parent_key(parent_id)
+    # a run stopped between writing the archive and the delete archives the same rows again next time
+    rows_by_pk = {}
+    f = open(get_archive_path(model, parent_id), 'rb')
+    try:
+        for start, length in members:
+            f.seek(start)
+            member = gzip.GzipFile(fileobj=io.BytesIO(f.read(length)), mode='rb')
+            for line in member:
+                row = json.loads(line)
+                if _get_parent_key(row['fields'][parent_field.name]) == key:
+                    rows_by_pk[row['pk']] = row
+    finally:
+        f.close()
+    rows = [rows_by_pk[x] for x in sorted(rows_by_pk)]
+    return [x.object for x in serializers.deserialize('python', rows)]
+
+
+def get_history(model, parent, include_archive=True):
+    """
+    All the history rows for parent, newest first, whether they are in the table or the archive
+    """
+    parent_field = _get_parent_field(model)
+    rows = list(model.objects.filter(**{parent_field.name: parent}))
+    if include_archive:
+        in_table = set(x.pk for x in rows)
+        # a row can be in both if archiving was stopped between writing the archive and the delete
+        rows.extend([x for x in read_archived_history(model, parent.pk) if x.pk not in in_table])
+    rows.sort(key=lambda x: (x.changed_on, x.pk), reverse=True)
+    return rows
@@ -0,0 +1,32 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from dj_extras.models import HistoryTrack
+
+
+class Command(BaseCommand):
+    args = 'app_label.ModelName ...'
+    help = 'Move old history rows out of the database into the history archive'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=365,
+                    help='Keep this many days of history in the database'),
+    )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        for model_name in args:
+            try:
+                model = apps.get_model(model_name)
+            except (LookupError, ValueError):
+                raise CommandError('Model "%s" does not exist' % model_name)
+
+            if not issubclass(model, HistoryTrack):
+                raise CommandError('Model "%s" is not a HistoryTrack' % model_name)
+
+            count = model.archive_history(before)
+            self.stdout.write("%s: archived %d rows" % (model_name, count))
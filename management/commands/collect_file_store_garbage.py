@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dj_extras.file_store import collect_content_store_garbage, get_content_store_root, humanize_file_size
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Remove files from the content store which are no longer linked from any object folder'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report what would be removed'),
+    )
+
+    def handle(self, *args, **options):
+        if not get_content_store_root():
+            raise CommandError("settings.FILE_CONTENT_STORE_ROOT is not set")
+
+        count, size = collect_content_store_garbage(dry_run=options['dry_run'])
+
+        self.stdout.write("%s %d files (%s)" % ("Would remove" if options['dry_run'] else "Removed",
+                                                count, humanize_file_size(size)))
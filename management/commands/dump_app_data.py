@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dj_extras.orm_dump import dump_app_data, ORM_DUMP_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    args = 'app_name [app_name ...]'
+    help = 'Dump the data of apps through the ORM to a compressed file (works with any database)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path', default=None,
+                    help='Where to write the dump (only with one app)'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=ORM_DUMP_CHUNK_SIZE,
+                    help='How many rows to read at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if options['path'] and len(args) != 1:
+            raise CommandError("--path only works with one app")
+
+        for app_name in args:
+            rval = dump_app_data(app_name, options['path'], options['chunk_size'])
+            if rval['error']:
+                raise CommandError(rval['error'])
+            self.stdout.write("Dumped %d rows of %s to %s in %.1f seconds" % (
+                sum(rval['counts'].values()), app_name, rval['dump_path'], rval['seconds']))
@@ -1,17 +1,30 @@
+from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 
-from dj_extras.mysql_utils import dump_mysql_db
+from dj_extras.mysql_utils import dump_mysql_db, dump_mysql_db_tables, MYSQL_DUMP_WORKERS
 
 class Command(BaseCommand):
     args = ''
     help = 'Dump App Databases via mysqldump'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--per-table', action='store_true', dest='per_table', default=False,
+                    help='Dump each table to its own file, a few at once, with a manifest'),
+        make_option('--workers', type='int', dest='workers', default=MYSQL_DUMP_WORKERS,
+                    help='How many tables to dump at once with --per-table'),
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+                    help='Per table dump skipping the tables that are unchanged since the last one'),
+    )
+
     def handle(self, *args, **options):
 
         app_name_list= args
         for app_name in app_name_list:
-            rval = dump_mysql_db(app_name)
+            if options['per_table'] or options['incremental']:
+                rval = dump_mysql_db_tables(app_name, workers=options['workers'], incremental=options['incremental'])
+            else:
+                rval = dump_mysql_db(app_name)
 
             if rval['error']:
                 raise CommandError(rval['error'])
@@ -0,0 +1,46 @@
+import os.path
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dj_extras.file_store import ingest_inbox_files, get_inbox_file_list, get_inbox_file_path, INGEST_THREAD_COUNT
+
+
+class Command(BaseCommand):
+    args = 'group kind folder [filename ...]'
+    help = 'Move files from the inbox into an object folder (all of the inbox if no files are given)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', dest='threads', default=INGEST_THREAD_COUNT,
+                    help='How many files to move at once'),
+        make_option('--no-verify', action='store_false', dest='verify', default=True,
+                    help='Skip checking digests of copied files'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help='Copy the files and leave them in the inbox'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) < 3:
+            raise CommandError("Usage: ingest_inbox_files %s" % self.args)
+
+        group, kind, folder = args[0:3]
+        # folders in the inbox aren't files to ingest
+        filenames = args[3:] or [x for x in get_inbox_file_list(group)
+                                 if os.path.isfile(get_inbox_file_path(x, group, create=False))]
+
+        def progress(done, total, result):
+            if result['error']:
+                self.stderr.write("%d/%d %s failed: %s" % (done, total, result['filename'], result['error']))
+            elif int(options['verbosity']) > 1:
+                self.stdout.write("%d/%d %s" % (done, total, result['filename']))
+
+        results = ingest_inbox_files(filenames, group, kind, folder,
+                                     verify=options['verify'],
+                                     remove_from_inbox=not options['keep'],
+                                     thread_count=options['threads'],
+                                     progress=progress)
+
+        failed = [x for x in results if x['error']]
+        self.stdout.write("Ingested %d of %d files" % (len(results) - len(failed), len(results)))
+        if failed:
+            raise CommandError("%d files failed" % len(failed))
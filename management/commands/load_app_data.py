@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dj_extras.orm_dump import load_app_data, ORM_DUMP_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    args = 'app_name [app_name ...]'
+    help = 'Load app data written by dump_app_data'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path', default=None,
+                    help='The dump to load (only with one app)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=ORM_DUMP_CHUNK_SIZE,
+                    help='How many rows to insert at a time'),
+        make_option('--clear', action='store_true', dest='clear', default=False,
+                    help="Delete the app's rows before loading"),
+    )
+
+    def handle(self, *args, **options):
+        if options['path'] and len(args) != 1:
+            raise CommandError("--path only works with one app")
+
+        for app_name in args:
+            rval = load_app_data(app_name, options['path'], options['batch_size'], options['clear'])
+            if rval['error']:
+                raise CommandError(rval['error'])
+            self.stdout.write("Loaded %d rows of %s from %s in %.1f seconds" % (
+                sum(rval['counts'].values()), app_name, rval['dump_path'], rval['seconds']))
@@ -1,17 +1,34 @@
 
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
 
-from dj_extras.mysql_utils import load_mysql_db
+from dj_extras.mysql_utils import load_mysql_db, load_mysql_db_tables, MYSQL_DUMP_WORKERS
 
 
 class Command(BaseCommand):
     args = ''
     help = 'Load Compressed mysql db into app'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--per-table', action='store_true', dest='per_table', default=False,
+                    help='Load the per table files made by dump_to_mysql --per-table, a few at once'),
+        make_option('--workers', type='int', dest='workers', default=MYSQL_DUMP_WORKERS,
+                    help='How many tables to load at once with --per-table'),
+        make_option('--no-verify', action='store_false', dest='verify', default=True,
+                    help="Don't check the files against the manifest before loading"),
+        make_option('--only-changed', action='store_true', dest='only_changed', default=False,
+                    help='Per table load of just the tables whose files changed since the last load'),
+    )
+
     def handle(self, *args, **options):
         app_name_list= args
         for app_name in app_name_list:
-            rval = load_mysql_db(app_name)
+            if options['per_table'] or options['only_changed']:
+                rval = load_mysql_db_tables(app_name, workers=options['workers'], verify=options['verify'],
+                                            only_changed=options['only_changed'])
+            else:
+                rval = load_mysql_db(app_name)
 
             if rval['error']:
                 raise CommandError(rval['error'])
\ No newline at end of file
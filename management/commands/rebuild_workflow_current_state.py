@@ -0,0 +1,22 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from dj_extras.models import WorkflowItemCurrentState
+
+
+class Command(BaseCommand):
+    args = 'app_label.ModelName ...'
+    help = 'Set the denormalized current state of workflow items from their trackers'
+
+    def handle(self, *args, **options):
+        for model_name in args:
+            try:
+                model = apps.get_model(model_name)
+            except (LookupError, ValueError):
+                raise CommandError('Model "%s" does not exist' % model_name)
+
+            if not issubclass(model, WorkflowItemCurrentState):
+                raise CommandError('Model "%s" is not a WorkflowItemCurrentState' % model_name)
+
+            count = model.rebuild_current_state()
+            self.stdout.write("%s: updated %d items" % (model_name, count))
@@ -0,0 +1,16 @@
+from dj_extras.utils import start_lookup_memo, end_lookup_memo
+
+
+class LookupMemoMiddleware(object):
+    """
+    Memoize get_or_none_cached lookups for the length of each request
+    """
+    def process_request(self, request):
+        start_lookup_memo()
+
+    def process_response(self, request, response):
+        end_lookup_memo()
+        return response
+
+    def process_exception(self, request, exception):
+        end_lookup_memo()
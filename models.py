@@ -1,13 +1,19 @@
-from django.db import models
+from django.db import models, connections, router, transaction
 
 from django.contrib.auth.models import User
 from django.core.validators import RegexValidator
+from django.utils import timezone
 
 import uuid
+import time
+import random
+from django import forms as django_forms
 
 from forms import ParameterTypes
 
 from regexes import LEGAL_FILENAME_REGEX, LEGAL_PATHNAME_REGEX, HEX_REGEX
+from file_store import get_inbox_file_list
+from dj_extras import utils  # connects the cached lookup invalidation in every process
 
 TITLE_FIELD_LENGTH = 250
 MODEL_NAME_FIELD_LENGTH = 100
@@ -21,22 +27,126 @@ MODEL_GUID_LENGTH = 64
 MODEL_SHA256_LENGTH = 64
 
 
+_system_random = random.SystemRandom()
+
+
+def random_uuid_string():
+    return str(uuid.uuid4())
+
+
+def time_ordered_uuid():
+    """
+    A uuid in the style of version 7. The first 48 bits are the unix time in milliseconds
+    so ids made one after the other land next to each other in an index.
+    """
+    millis = int(time.time() * 1000)
+    rand = _system_random.getrandbits(74)
+    value = (millis & 0xFFFFFFFFFFFF) << 80       # 48 bits of time
+    value |= 0x7 << 76                             # version
+    value |= (rand >> 62) << 64                    # 12 random bits
+    value |= 0x2 << 62                             # variant
+    value |= rand & 0x3FFFFFFFFFFFFFFF             # 62 random bits
+    return uuid.UUID(int=value)
+
+
+def time_ordered_uuid_string():
+    return str(time_ordered_uuid())
+
+
 class UUIDField(models.CharField) :
     """
     Ripped from http://djangosnippets.org/snippets/1262/
+
+    New instances get their uuid when they are made (so it is there for bulk_create)
+    With time_ordered=True the uuids start with the time so inserts go to the end of indexes
     """
     def __init__(self, *args, **kwargs):
         kwargs['max_length'] = kwargs.get('max_length', MODEL_GUID_LENGTH )
         kwargs['blank'] = True
+        self.time_ordered = kwargs.pop('time_ordered', False)
+        if 'default' not in kwargs:
+            kwargs['default'] = time_ordered_uuid_string if self.time_ordered else random_uuid_string
         models.CharField.__init__(self, *args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(UUIDField, self).deconstruct()
+        if kwargs.get('default') in (random_uuid_string, time_ordered_uuid_string):
+            del kwargs['default']
+        if self.time_ordered:
+            kwargs['time_ordered'] = True
+        return name, path, args, kwargs
+
     def pre_save(self, model_instance, add):
-        if add:
-            value = str(uuid.uuid4()) # uses a random uuid
+        value = getattr(model_instance, self.attname)
+        if add and not value:
+            value = self.get_default()
             setattr(model_instance, self.attname, value)
+        return value
+
+
+class BinaryUUIDField(models.Field):
+    """
+    Like UUIDField (the values are the same strings in python) but stored in 16 bytes, or
+    the database's own uuid type where there is one, so tables and indexes are smaller
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, *args, **kwargs):
+        kwargs['blank'] = True
+        self.time_ordered = kwargs.pop('time_ordered', False)
+        if 'default' not in kwargs:
+            kwargs['default'] = time_ordered_uuid_string if self.time_ordered else random_uuid_string
+        super(BinaryUUIDField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(BinaryUUIDField, self).deconstruct()
+        del kwargs['blank']
+        if kwargs.get('default') in (random_uuid_string, time_ordered_uuid_string):
+            del kwargs['default']
+        if self.time_ordered:
+            kwargs['time_ordered'] = True
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'uuid'
+        if connection.vendor == 'mysql':
+            return 'binary(16)'
+        if connection.vendor == 'oracle':
+            return 'RAW(16)'
+        return 'blob'
+
+    def to_python(self, value):
+        if value is None or value == '':
             return value
-        else:
-            return super(models.CharField, self).pre_save(model_instance, add)
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        if isinstance(value, (buffer, bytearray)) or (isinstance(value, str) and len(value) == 16):
+            return str(uuid.UUID(bytes=str(value)))
+        return str(uuid.UUID(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = self.to_python(value)
+        if not value:
+            return None
+        if connection.vendor == 'postgresql':
+            return value
+        return connection.Database.Binary(uuid.UUID(value).bytes)
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname)
+        if add and not value:
+            value = self.get_default()
+            setattr(model_instance, self.attname, value)
+        return value
+
+    def value_to_string(self, obj):
+        return self._get_val_from_obj(obj)
+
+    def formfield(self, **kwargs):
+        defaults = dict(form_class=django_forms.CharField, max_length=36)
+        defaults.update(kwargs)
+        return super(BinaryUUIDField, self).formfield(**defaults)
 
 
 class BigIntegerAuto(models.AutoField):
@@ -159,15 +269,79 @@ class PathNameField(models.CharField):
         super(PathNameField, self).__init__(*args, **kwargs)
 
 
+def _has_relation(model, name):
+    """
+    Whether select_related can follow name from model
+    """
+    try:
+        field, _, direct, m2m = model._meta.get_field_by_name(name)
+    except models.FieldDoesNotExist:
+        return False
+    if m2m:
+        return False
+    return field.rel is not None if direct else isinstance(field.field, models.OneToOneField)
+
+
+class ChildClassViewerQuerySet(models.QuerySet):
+
+    def as_children(self, *select_related):
+        """
+        Returns a list of the rows as their child classes using one query per child class
+        """
+        return self.model.get_children(self, *select_related)
+
+
 class ChildClassViewer(models.Model):
     _item_subclass = CleanLabelField()
 
+    objects = ChildClassViewerQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
     def as_child(self):
         return getattr(self, self._item_subclass)
 
+    @classmethod
+    def get_child_classes(cls):
+        """
+        A dict of _item_subclass names to the child classes of this one
+        """
+        return dict((x.get_accessor_name(), x.model) for x in cls._meta.get_all_related_objects()
+                    if isinstance(x.field, models.OneToOneField) and x.field.rel.parent_link)
+
+    @classmethod
+    def get_children(cls, items, *select_related):
+        """
+        Like calling as_child on each of items but fetching each child class's rows in one query.
+        Each select_related name is applied to the child class queries of the classes which have that
+        relation (every name has to be on at least one of them). Returns a list in the order of items
+        """
+        items = list(items)
+        child_classes = cls.get_child_classes()
+        related_by_subclass = {}
+        for name in select_related:
+            subclasses = [x for x, model in child_classes.items() if _has_relation(model, name.split('__')[0])]
+            assert subclasses, "No child class of %s has a relation %s" % (cls.__name__, name)
+            for subclass in subclasses:
+                related_by_subclass.setdefault(subclass, []).append(name)
+
+        pks_by_subclass = {}
+        for item in items:
+            if item._item_subclass in child_classes:
+                pks_by_subclass.setdefault(item._item_subclass, []).append(item.pk)
+
+        children = {}
+        for subclass, pks in pks_by_subclass.items():
+            qs = child_classes[subclass].objects.filter(pk__in=pks)
+            if subclass in related_by_subclass:
+                qs = qs.select_related(*related_by_subclass[subclass])
+            for child in qs:
+                children[(subclass, child.pk)] = child
+
+        # items of this class itself, or of something we couldn't find, are left as they are
+        return [children.get((x._item_subclass, x.pk), x) for x in items]
+
     def sub_class(self):
         return self._item_subclass
 
@@ -176,9 +350,38 @@ class ChildClassViewer(models.Model):
         super(ChildClassViewer, self).save(*args, **kwargs) # Call the "real" save() method.
 
 
+TRACKING_USER_FIELDS = ('changed_by', 'created_by')
+
+
+class TrackingUserQuerySet(models.QuerySet):
+
+    def with_users(self, only_username=False):
+        """
+        Fetch the changed_by/created_by users in the same query. With only_username the
+        other columns of the user table are left out
+        """
+        names = [x for x in TRACKING_USER_FIELDS if x in self.model._meta.get_all_field_names()]
+        qs = self.select_related(*names)
+        if only_username:
+            qs = qs.defer(*["%s__%s" % (name, f.name) for name in names
+                            for f in User._meta.concrete_fields if f.name not in ('id', 'username')])
+        return qs
+
+
+class TrackingUserManager(models.Manager.from_queryset(TrackingUserQuerySet)):
+    """
+    Lists of tracked objects nearly always show who changed them so get the users
+    in the same query instead of one query per row
+    """
+    def get_queryset(self):
+        return super(TrackingUserManager, self).get_queryset().with_users()
+
+
 class TrackingChangesDateUser(models.Model):
     changed_by = models.ForeignKey(User, related_name="%(class)s_changed_by")
-    changed_on = models.DateTimeField(auto_now=True)
+    changed_on = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = TrackingUserManager()
 
     class Meta:
         abstract = True
@@ -188,6 +391,8 @@ class TrackingCreatedDateUser(models.Model):
     created_by = models.ForeignKey(User, related_name="%(class)s_created_by")
     created_on = models.DateTimeField(auto_now_add=True)
 
+    objects = TrackingUserManager()
+
     class Meta:
         abstract = True
 
@@ -210,6 +415,9 @@ class HistoryTrack(TrackingChangesDateUser):
     Base Class for objects which track history of database changes
     """
 
+    # The name of the link to the object this is the history of. Needed for archiving
+    history_parent_field = None
+
     class Meta:
         ordering = ['-changed_on']
         abstract = True
@@ -218,6 +426,22 @@ class HistoryTrack(TrackingChangesDateUser):
     def __unicode__(self):
         return self.changed_by.username + u":" + unicode(self.changed_on)
 
+    @classmethod
+    def archive_history(cls, before):
+        """
+        Move rows older than before (except the latest for each parent) to the archive. See history_archive.py
+        """
+        from history_archive import archive_history
+        return archive_history(cls, before)
+
+    @classmethod
+    def get_history(cls, parent, include_archive=True):
+        """
+        All the history of parent newest first including anything archived
+        """
+        from history_archive import get_history
+        return get_history(cls, parent, include_archive)
+
 
 
 #
@@ -234,6 +458,13 @@ class AnnotationNote(TrackingFullDateUser):
 
     def make_history(self, user, txt):
         pass
+
+    def build_history(self, user, txt):
+        """
+        Return an unsaved history object like make_history would save so bulk_update_notes
+        can bulk_create them. If this returns None bulk_update_notes calls make_history instead
+        """
+        return None
     
     def update(self, user, txt, with_history=True):
         self.changed_by = user
@@ -242,6 +473,39 @@ class AnnotationNote(TrackingFullDateUser):
         self.note_txt = txt
         self.save()
 
+    @classmethod
+    def bulk_update_notes(cls, note_txt_pairs, user, with_history=True):
+        """
+        Like calling update for each (note, txt) pair but with a few queries for the lot.
+        Notes whose text isn't changing are skipped. Returns the list of notes which changed
+        """
+        changed = [(note, txt) for note, txt in note_txt_pairs if note.note_txt != txt]
+        if not changed:
+            return []
+
+        now = timezone.now()
+        db = router.db_for_write(cls)
+        notes = [note for note, txt in changed]
+
+        with transaction.atomic(using=db):
+            if with_history:
+                histories = {}
+                for note, txt in changed:
+                    history = note.build_history(user, txt)
+                    if history is None:
+                        note.make_history(user, txt)
+                    else:
+                        histories.setdefault(type(history), []).append(history)
+                for history_class, objs in histories.items():
+                    history_class.objects.bulk_create(objs)
+
+            for note, txt in changed:
+                note.note_txt = txt
+                note.changed_by = user
+                note.changed_on = now
+            utils.bulk_update_model_fields(cls, notes, ['note_txt', 'changed_by', 'changed_on'], using=db)
+        return notes
+
     def get_recent_items(self, count):
         # return self.linkedhistory_set.all().order_by('-changed_on')[0:count]
         pass
@@ -258,6 +522,58 @@ class NoteHistory(HistoryTrack):
 # Some classes for making "Done" checkboxes which can be attached to other objects
 # see tests.py for examples
 #
+def attach_current_trackers(items, batch_size=500):
+    """
+    Find the current tracker of each of a list of workflow items with one query (per batch_size items)
+    and save it on the item so current_tracker, get_current_state and get_info_html don't query.
+    """
+    items = [x for x in items if x.pk is not None]
+    if not items:
+        return items
+
+    tracking_model = items[0].get_tracking_manager().model
+    opts = tracking_model._meta
+    qn = connections[router.db_for_read(tracking_model)].ops.quote_name
+    sql_info = dict(table=qn(opts.db_table),
+                    fk=qn(opts.get_field('workflow_item').column),
+                    changed_on=qn(opts.get_field('changed_on').column))
+    latest_clause = ("%(table)s.%(changed_on)s = (SELECT MAX(s2.%(changed_on)s) FROM %(table)s s2 "
+                     "WHERE s2.%(fk)s = %(table)s.%(fk)s)" % sql_info)
+
+    trackers = {}
+    for idx in range(0, len(items), batch_size):
+        batch = items[idx:idx + batch_size]
+        qs = tracking_model.objects.filter(workflow_item__in=batch).extra(where=[latest_clause])
+        for tracker in qs.select_related('changed_by').order_by('pk'):
+            trackers[tracker.workflow_item_id] = tracker   # the last one wins a tie
+
+    for item in items:
+        item._current_tracker = trackers.get(item.pk)
+    return items
+
+
+class WorkflowItemQuerySet(models.QuerySet):
+
+    def with_current_trackers(self):
+        """
+        The items come back with their current trackers already attached
+        """
+        clone = self._clone()
+        clone._attach_current_trackers = True
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(WorkflowItemQuerySet, self)._clone(*args, **kwargs)
+        clone._attach_current_trackers = getattr(self, '_attach_current_trackers', False)
+        return clone
+
+    def _fetch_all(self):
+        fetch = self._result_cache is None
+        super(WorkflowItemQuerySet, self)._fetch_all()
+        if fetch and getattr(self, '_attach_current_trackers', False):
+            attach_current_trackers([x for x in self._result_cache if isinstance(x, WorkflowItem)])
+
+
 class WorkflowItem(models.Model):
     """
     A base class for workflow item status.
@@ -275,12 +591,16 @@ class WorkflowItem(models.Model):
     link_info = models.CharField(max_length=200)
     priority = models.PositiveSmallIntegerField(default=0, help_text="Order to show in list")
 
+    objects = WorkflowItemQuerySet.as_manager()
+
     class Meta:
         abstract = True
         ordering = ['priority']
 
 
     def current_tracker(self):
+        if hasattr(self, '_current_tracker'):
+            return self._current_tracker
         try:
             tracker=self.get_tracking_manager().filter(workflow_item = self).order_by('-changed_on')[0]
             return tracker
@@ -301,7 +621,19 @@ class WorkflowItem(models.Model):
         return self.display_name
     
     def update(self, user, state):
-        return self.get_tracking_manager().create(workflow_item = self, changed_by=user, state = state)
+        with transaction.atomic():
+            # lock the item so concurrent updates make their trackers (and set the current one) one at a time
+            list(type(self)._base_manager.select_for_update().filter(pk=self.pk).values_list('pk', flat=True))
+            tracker = self.get_tracking_manager().create(workflow_item = self, changed_by=user, state = state)
+            self.set_current_tracker(tracker)
+        return tracker
+
+    def set_current_tracker(self, tracker):
+        """
+        Called in the same transaction as the tracker is made
+        """
+        if hasattr(self, '_current_tracker'):
+            self._current_tracker = tracker
 
 
     def get_info_html(self):
@@ -322,6 +654,70 @@ class WorkflowItem(models.Model):
         return u"%s" % self.display_name
 
 
+class WorkflowItemCurrentStateManager(models.Manager.from_queryset(WorkflowItemQuerySet)):
+    """
+    get_info_html shows who set the current state so get them in the same query instead of one per row
+    """
+    def get_queryset(self):
+        return super(WorkflowItemCurrentStateManager, self).get_queryset().select_related('current_changed_by')
+
+
+class WorkflowItemCurrentState(WorkflowItem):
+    """
+    A WorkflowItem which keeps a copy of its current state so you can filter on it
+    like Foo.objects.exclude(current_state=DONE)
+
+    Use the rebuild_workflow_current_state command to fill these in for existing data
+    """
+    current_state = models.IntegerField(default=-1, db_index=True)
+    current_changed_on = models.DateTimeField(blank=True, null=True)
+    current_changed_by = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL,
+                                           related_name="%(class)s_current_changed_by")
+
+    objects = WorkflowItemCurrentStateManager()
+
+    class Meta:
+        abstract = True
+        ordering = ['priority']
+
+    def set_current_tracker(self, tracker):
+        super(WorkflowItemCurrentState, self).set_current_tracker(tracker)
+        values = dict(current_state=tracker.state if tracker else -1,
+                      current_changed_on=tracker.changed_on if tracker else None,
+                      current_changed_by=tracker.changed_by if tracker else None)
+        # the base manager so a default manager filtering rows out can't make this update nothing
+        type(self)._base_manager.filter(pk=self.pk).update(**values)
+        for field, value in values.items():
+            setattr(self, field, value)
+
+    def get_current_state(self):
+        return self.current_state
+
+    def get_info_html(self):
+        if self.current_state > 0 and self.current_changed_by_id:
+            return u"- by %s on %s" % (self.current_changed_by.username, str(self.current_changed_on.ctime()))
+        else:
+            return ""
+
+    @classmethod
+    def rebuild_current_state(cls, batch_size=500):
+        """
+        Set the current state columns from the trackers. Returns the number of items changed
+        """
+        count = 0
+        pks = list(cls.objects.order_by('pk').values_list('pk', flat=True))
+        for idx in range(0, len(pks), batch_size):
+            with transaction.atomic():
+                items = cls.objects.filter(pk__in=pks[idx:idx + batch_size]).with_current_trackers()
+                for item in items:
+                    tracker = item.current_tracker()
+                    old = (item.current_state, item.current_changed_on, item.current_changed_by_id)
+                    new = (tracker.state, tracker.changed_on, tracker.changed_by_id) if tracker else (-1, None, None)
+                    if old != new:
+                        item.set_current_tracker(tracker)
+                        count += 1
+        return count
+
 
 class WorkflowItemStatus(HistoryTrack):
     """
@@ -335,9 +731,13 @@ class WorkflowItemStatus(HistoryTrack):
     # Need to add a link field called
     #
     # workflow_item
+    history_parent_field = 'workflow_item'
+
     class Meta:
         abstract = True
         ordering = ('-changed_on',)
+        # for the latest tracker of an item and its history newest first
+        index_together = [('workflow_item', 'changed_on')]
 
     def __unicode__(self):
         return u"%d: %s %s" % (self.state, str(self.changed_on), self.changed_by.username)
@@ -375,26 +775,87 @@ class OptionInfo(models.Model):
 #
 # Stuff for managing the Inbox
 #
+INBOX_SYNC_BATCH_SIZE = 500
+
+
+def _chunks(items, size):
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
 class InboxFileStoreTrackFile(models.Model):
     class Meta:
         abstract = True
+        index_together = [('folder', 'filename')]
 
     filename = FileNameField()
     folder = CleanLabelField() # could be lab name
     created_on = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User)
 
+    @classmethod
+    def sync_inbox_files(cls, folder, filenames, user):
+        """
+        Make sure there is a tracking row for each of filenames in folder.
+        Returns a dict with the filenames which were added and the tracked ones which aren't in filenames
+        """
+        filenames = set(filenames)
+        tracked = set(cls.objects.filter(folder=folder).values_list('filename', flat=True))
+        created = sorted(filenames - tracked)
+        cls.objects.bulk_create([cls(folder=folder, filename=x, created_by=user) for x in created])
+        return dict(created=created, missing=sorted(tracked - filenames))
+
+    @classmethod
+    def sync_inbox_group(cls, group, user, extensions=None):
+        """
+        Track everything in the inbox for group
+        """
+        return cls.sync_inbox_files(group, get_inbox_file_list(group, extensions), user)
+
 
 class InboxFileStoreTrackItem(models.Model):
+    """
+    Need to add a link field called file to a derived class of InboxFileStoreTrackFile
+    """
     class Meta:
         abstract = True
+        index_together = [('file', 'used')]
 
-    file = models.ForeignKey(InboxFileStoreTrackFile)
+    # file = models.ForeignKey(ChildOfInboxFileStoreTrackFile)
     item = CleanLabelField() # could be sample id
     used = models.BooleanField(default = False)
     used_on = models.DateTimeField(auto_now=True)
     used_by = models.ForeignKey(User)
 
-
-
-
+    @classmethod
+    def sync_inbox_items(cls, file_items, user, batch_size=INBOX_SYNC_BATCH_SIZE):
+        """
+        file_items is a dict of tracking file -> item names. Adds the items which aren't tracked yet.
+        Returns the number added
+        """
+        created = []
+        for files in _chunks(file_items, batch_size):
+            tracked = set(cls.objects.filter(file__in=files).values_list('file', 'item'))
+            created.extend([cls(file=f, item=x, used_by=user) for f in files
+                            for x in set(file_items[f]) if (f.pk, x) not in tracked])
+        cls.objects.bulk_create(created)
+        return len(created)
+
+    @classmethod
+    def mark_items_used(cls, files, user, items=None, used=True, batch_size=INBOX_SYNC_BATCH_SIZE):
+        """
+        Set used for the items (or all the items) of files. Returns the number of rows changed
+        """
+        count = 0
+        if items is not None:
+            # both IN lists go in each UPDATE so they share the batch to keep under sqlite's variable limit
+            batch_size = max(1, batch_size // 2)
+        for file_chunk in _chunks(files, batch_size):
+            qs = cls.objects.filter(file__in=file_chunk).exclude(used=used)
+            if items is None:
+                count += qs.update(used=used, used_by=user, used_on=timezone.now())
+                continue
+            for item_chunk in _chunks(items, batch_size):
+                count += qs.filter(item__in=item_chunk).update(used=used, used_by=user, used_on=timezone.now())
+        return count
@@ -1,11 +1,21 @@
 
 from django.conf import settings
 
+import datetime
+import json
+import multiprocessing
+import os
+import os.path
+import re
 import subprocess
+from multiprocessing.pool import ThreadPool
 
+from django.db import connection
 from django.db.models import get_app, get_models
 from django.core.exceptions import *
 
+from file_store import insure_folder, get_sha256_digest_for_path, get_sha256_digests_for_paths
+
 
 def dump_mysql_db(app_name, tables = None, dump_path = None):
     """
@@ -67,3 +77,237 @@ def load_mysql_db(app_name, dump_path = None):
     return dict(error=None, dump_path=load_info['dump_path'])
 
 
+
+#
+# Dumping and loading a table per file. Each table goes to its own gzipped file in the app's dump folder
+# (settings.MYSQL_DUMP_ROOT/app_name/ by default) and a few tables are dumped or loaded at once.
+# manifest.json in the folder lists the tables with their row counts, fingerprints and the sha256 of their files.
+# The fingerprints let an incremental dump skip tables that haven't changed since the last one.
+#
+MYSQL_DUMP_WORKERS = multiprocessing.cpu_count()
+MYSQL_MANIFEST_NAME = 'manifest.json'
+
+
+def _get_mysql_info(**kwargs):
+    db = settings.DATABASES['default']
+    info = dict(username=db['USER'],
+                password=db.get('PASSWORD') or db['USER'],
+                db_name=db['NAME'])
+    info.update(kwargs)
+    return info
+
+
+def _run_shell(cmd):
+    """
+    Run a pipeline making any part of it failing count as failing
+    """
+    return subprocess.call(cmd, shell=True, executable='/bin/bash')
+
+
+def _run_in_pool(func, items, workers):
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            connection.close()  # each worker thread has its own connection
+
+    pool = ThreadPool(max(1, min(workers or MYSQL_DUMP_WORKERS, len(items))))
+    try:
+        return pool.map(run, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_mysql_dump_folder(app_name):
+    return os.path.join(settings.MYSQL_DUMP_ROOT, app_name)
+
+
+def get_mysql_app_tables(app):
+    return [x._meta.db_table for x in get_models(app, include_auto_created=True)]
+
+
+def read_mysql_dump_manifest(dump_folder):
+    path = os.path.join(dump_folder, MYSQL_MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_mysql_dump_manifest(dump_folder, manifest):
+    path = os.path.join(dump_folder, MYSQL_MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def get_mysql_table_fingerprint(table):
+    """
+    Something that changes when the table's data does: the row count and, on mysql, CHECKSUM TABLE.
+    Elsewhere it is only the row count which misses rows changed in place, so incremental dumps need mysql.
+    """
+    cursor = connection.cursor()
+    try:
+        qn = connection.ops.quote_name
+        cursor.execute("SELECT COUNT(*) FROM %s" % qn(table))
+        fingerprint = dict(rows=cursor.fetchone()[0])
+        if connection.vendor == 'mysql':
+            cursor.execute("CHECKSUM TABLE %s" % qn(table))
+            fingerprint['checksum'] = cursor.fetchone()[1]
+        return fingerprint
+    finally:
+        cursor.close()
+
+
+def _dump_mysql_table(table, dump_folder, previous=None):
+    """
+    Dump one table. If previous (its manifest entry from the last dump) has the same fingerprint
+    and its file is still there the table hasn't changed and is skipped
+    """
+    file_name = "%s.sql.gz" % table
+    dump_info = _get_mysql_info(table=table, dump_path=os.path.join(dump_folder, file_name))
+    dump_info['tmp_path'] = dump_info['dump_path'] + '.tmp'
+
+    # taken before the dump so a change while dumping shows up next time
+    fingerprint = get_mysql_table_fingerprint(table)
+    if previous and previous.get('fingerprint') == fingerprint and os.path.exists(dump_info['dump_path']):
+        return dict(previous, table=table, error=None, skipped=True)
+
+    cmd = ("set -o pipefail; mysqldump -u%(username)s -p%(password)s --skip-dump-date --skip-add-locks --no-create-info "
+           "--opt %(db_name)s %(table)s | gzip -n > %(tmp_path)s" % dump_info)
+    if _run_shell(cmd):
+        if os.path.exists(dump_info['tmp_path']):
+            os.remove(dump_info['tmp_path'])
+        return dict(table=table, error="Dump of %s failed" % table)
+    os.rename(dump_info['tmp_path'], dump_info['dump_path'])
+    return dict(table=table, error=None, skipped=False, file=file_name, rows=fingerprint['rows'],
+                fingerprint=fingerprint, dumped_on=datetime.datetime.utcnow().isoformat(),
+                sha256=get_sha256_digest_for_path(dump_info['dump_path']))
+
+
+def dump_mysql_db_tables(app_name, tables=None, dump_folder=None, workers=None, incremental=False):
+    """
+    Dump each table of the app to its own file with a few dumps running at once.
+    app_name - the name of the django app
+    tables - an optional list of tables to dump (defaults to all)
+    dump_folder - folder for the files and manifest (defaults to settings.MYSQL_DUMP_ROOT/app_name)
+    workers - how many tables to dump at once (defaults to the number of cpus)
+    incremental - only dump tables whose fingerprint changed since the dump in the manifest (mysql only)
+    Returns the usual dict with the new manifest and the list of tables actually dumped
+    """
+    try:
+        app = get_app(app_name)
+    except ImproperlyConfigured:
+        return dict(error='App "%s" does not exist' % app_name)
+
+    if incremental and connection.vendor != 'mysql':
+        return dict(error="Incremental dumps need CHECKSUM TABLE, %s doesn't have it" % connection.vendor)
+
+    dump_folder = dump_folder or get_mysql_dump_folder(app_name)
+    insure_folder(dump_folder)
+    app_tables = get_mysql_app_tables(app)
+    previous_infos = (read_mysql_dump_manifest(dump_folder) or {}).get('tables', {})
+    # a full dump starts a new manifest, otherwise the tables not dumped this time keep their entries
+    # as long as the app still has them
+    if tables or incremental:
+        table_infos = dict((k, v) for k, v in previous_infos.items() if k in app_tables)
+    else:
+        table_infos = {}
+    tables = tables or app_tables
+
+    def dump(table):
+        return _dump_mysql_table(table, dump_folder, table_infos.get(table) if incremental else None)
+
+    results = _run_in_pool(dump, tables, workers)
+    errors = [x['error'] for x in results if x['error']]
+    if errors:
+        return dict(error=", ".join(errors), dump_path=dump_folder)
+
+    dumped = [x['table'] for x in results if not x['skipped']]
+    for x in results:
+        for key in ('error', 'skipped'):
+            del x[key]
+        table_infos[x.pop('table')] = x
+    manifest = dict(app_name=app_name,
+                    created_on=datetime.datetime.utcnow().isoformat(),
+                    tables=table_infos)
+    write_mysql_dump_manifest(dump_folder, manifest)
+
+    kept_files = set(x['file'] for x in table_infos.values())
+    for info in previous_infos.values():
+        stale_path = os.path.join(dump_folder, info['file'])
+        if info['file'] not in kept_files and os.path.exists(stale_path):
+            os.remove(stale_path)
+    return dict(error=None, dump_path=dump_folder, manifest=manifest, dumped=dumped)
+
+
+def _get_loaded_record_path(dump_folder):
+    return os.path.join(dump_folder, "loaded-%s.json" % re.sub(r'[^\w.-]', '_', _get_mysql_info()['db_name']))
+
+
+def _load_mysql_table(table, info, dump_folder, clear=False):
+    load_info = _get_mysql_info(dump_path=os.path.join(dump_folder, info['file']),
+                                clear="DELETE FROM %s;" % connection.ops.quote_name(table) if clear else "")
+    # each load is its own mysql session so these only apply to it
+    cmd = ("set -o pipefail; (echo 'SET FOREIGN_KEY_CHECKS=0; SET UNIQUE_CHECKS=0; SET autocommit=0; %(clear)s'; "
+           "gunzip < %(dump_path)s; echo 'COMMIT;') | mysql -u %(username)s -p%(password)s %(db_name)s" % load_info)
+    if _run_shell(cmd):
+        return "Load of %s failed" % table
+    return None
+
+
+def load_mysql_db_tables(app_name, dump_folder=None, tables=None, workers=None, verify=True, only_changed=False):
+    """
+    Load the per table files written by dump_mysql_db_tables with a few tables loading at once.
+    Foreign key and unique checks are off while loading. With verify the files are checked against
+    the manifest first. What was loaded is recorded next to the manifest (per database) so with
+    only_changed just the tables whose files changed since the last load are emptied and loaded again.
+    """
+    try:
+        get_app(app_name)
+    except ImproperlyConfigured:
+        return dict(error='App "%s" does not exist' % app_name)
+
+    dump_folder = dump_folder or get_mysql_dump_folder(app_name)
+    manifest = read_mysql_dump_manifest(dump_folder)
+    if not manifest:
+        return dict(error='No manifest in "%s"' % dump_folder)
+
+    table_infos = manifest['tables']
+    tables = tables or sorted(table_infos)
+    missing = [x for x in tables if x not in table_infos]
+    if missing:
+        return dict(error="Tables not in the manifest: %s" % ", ".join(missing))
+
+    loaded = {}
+    record_path = _get_loaded_record_path(dump_folder)
+    if os.path.exists(record_path):
+        with open(record_path) as f:
+            loaded = json.load(f)
+    if only_changed:
+        tables = [x for x in tables if loaded.get(x) != table_infos[x]['sha256']]
+
+    if verify:
+        paths = [os.path.join(dump_folder, table_infos[x]['file']) for x in tables]
+        digests = get_sha256_digests_for_paths([x for x in paths if os.path.exists(x)])
+        bad = [table for table, path in zip(tables, paths) if digests.get(path) != table_infos[table]['sha256']]
+        if bad:
+            return dict(error="Dump files don't match the manifest: %s" % ", ".join(bad))
+
+    def load(table):
+        return _load_mysql_table(table, table_infos[table], dump_folder, clear=only_changed and table in loaded)
+
+    results = _run_in_pool(load, tables, workers) if tables else []
+    for table, error in zip(tables, results):
+        if not error:
+            loaded[table] = table_infos[table]['sha256']
+    with open(record_path + '.tmp', 'w') as f:
+        json.dump(loaded, f, indent=2, sort_keys=True)
+    os.rename(record_path + '.tmp', record_path)
+
+    errors = [x for x in results if x]
+    if errors:
+        return dict(error=", ".join(errors), dump_path=dump_folder)
+    return dict(error=None, dump_path=dump_folder, tables=tables)
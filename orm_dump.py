@@ -0,0 +1,203 @@
+"""
+Dump and load an app's data through the ORM so it works on any database (mysql_utils needs mysql).
+
+The dump is a gzipped file of json lines. Each model starts with a header line
+    {"model": "app_label.ModelName", "fields": [attname, ...]}
+followed by a line per row holding a list of the values in the same order. Rows are read a chunk
+at a time ordered by pk and inserted a batch at a time (in one transaction) so memory use stays the
+same however big the tables are.
+"""
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import get_app, get_models, get_model
+from django.core.exceptions import *
+
+import gzip
+import itertools
+import json
+import os
+import os.path
+import time
+
+from file_store import insure_folder
+
+ORM_DUMP_CHUNK_SIZE = 2000
+
+
+def get_orm_dump_path(app_name):
+    return os.path.join(settings.MYSQL_DUMP_ROOT, "%s.jsonl.gz" % app_name)
+
+
+def _get_dump_fields(model):
+    # a child class only has its own table's columns, the parent class is dumped on its own
+    return model._meta.local_concrete_fields
+
+
+JSON_TYPES = (bool, int, long, float, basestring)
+
+
+def _get_portable_value(field, obj):
+    """
+    Values json handles as they are, anything else (dates, decimals, uuids..) as the field's string form
+    which its to_python reads back without losing anything
+    """
+    value = getattr(obj, field.attname)
+    if value is None or isinstance(value, JSON_TYPES):
+        return value
+    return field.value_to_string(obj)
+
+
+def _write_model_rows(f, model, using, chunk_size):
+    fields = _get_dump_fields(model)
+    f.write(json.dumps(dict(model="%s.%s" % (model._meta.app_label, model._meta.object_name),
+                            fields=[x.attname for x in fields])) + "\n")
+    count = 0
+    last_pk = None
+    qs = model._base_manager.using(using).order_by('pk')
+    while True:
+        chunk_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        rows = list(chunk_qs[0:chunk_size])
+        if not rows:
+            break
+        for obj in rows:
+            f.write(json.dumps([_get_portable_value(x, obj) for x in fields]) + "\n")
+        count += len(rows)
+        last_pk = rows[-1].pk
+    return count
+
+
+def dump_app_data(app_name, dump_path=None, chunk_size=ORM_DUMP_CHUNK_SIZE):
+    """
+    Write all the rows of all the models of the app to dump_path (defaults to settings.MYSQL_DUMP_ROOT/app_name.jsonl.gz)
+    Returns the usual error dict along with the row count for each model and how long it took
+    """
+    try:
+        app = get_app(app_name)
+    except ImproperlyConfigured:
+        return dict(error='App "%s" does not exist' % app_name)
+
+    dump_path = dump_path or get_orm_dump_path(app_name)
+    insure_folder(os.path.dirname(dump_path))
+    start = time.time()
+    counts = {}
+    tmp_path = dump_path + '.tmp'
+    f = gzip.open(tmp_path, 'wb')
+    try:
+        for model in get_models(app, include_auto_created=True):
+            counts["%s.%s" % (model._meta.app_label, model._meta.object_name)] = \
+                _write_model_rows(f, model, router.db_for_read(model), chunk_size)
+    except:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    f.close()
+    os.rename(tmp_path, dump_path)
+
+    return dict(error=None, dump_path=dump_path, counts=counts, seconds=time.time() - start)
+
+
+def _insert_batch(model, objs, fields, using):
+    """
+    What bulk_create does but raw so auto_now fields keep their dumped values (and it works for child classes)
+    """
+    connection = connections[using]
+    batch_size = max(1, connection.ops.bulk_batch_size(fields, objs))
+    manager = model._base_manager.db_manager(using)
+    for idx in range(0, len(objs), batch_size):
+        manager._insert(objs[idx:idx + batch_size], fields=fields, raw=True, using=using)
+
+
+class _ModelLoader(object):
+
+    def __init__(self, header, batch_size):
+        app_label, model_name = header['model'].split('.')
+        try:
+            self.model = get_model(app_label, model_name)
+        except LookupError:
+            self.model = None
+        if self.model is None:
+            raise ValueError('Model "%s" in the dump does not exist' % header['model'])
+        self.using = router.db_for_write(self.model)
+        fields_by_attname = dict((x.attname, x) for x in _get_dump_fields(self.model))
+        missing = [x for x in header['fields'] if x not in fields_by_attname]
+        if missing:
+            raise ValueError('%s has no fields %s' % (header['model'], ", ".join(missing)))
+        self.fields = [fields_by_attname[x] for x in header['fields']]
+        self.batch_size = batch_size
+        self.objs = []
+        self.count = 0
+
+    def add(self, values):
+        self.objs.append(self.model(**dict((field.attname, field.to_python(value))
+                                           for field, value in zip(self.fields, values))))
+        if len(self.objs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.objs:
+            _insert_batch(self.model, self.objs, self.fields, self.using)
+            self.count += len(self.objs)
+            self.objs = []
+
+
+def load_app_data(app_name, dump_path=None, batch_size=ORM_DUMP_CHUNK_SIZE, clear=False):
+    """
+    Load a file written by dump_app_data. The tables should be empty unless clear is set which deletes
+    their rows first. It all happens in one transaction with constraints checked once everything is in,
+    so nothing is left half loaded if it fails.
+    """
+    try:
+        app = get_app(app_name)
+    except ImproperlyConfigured:
+        return dict(error='App "%s" does not exist' % app_name)
+
+    dump_path = dump_path or get_orm_dump_path(app_name)
+    if not os.path.exists(dump_path):
+        return dict(error='No dump at "%s"' % dump_path)
+
+    start = time.time()
+    app_models = get_models(app, include_auto_created=True)
+    using = router.db_for_write(app_models[0]) if app_models else 'default'
+    connection = connections[using]
+    counts = {}
+    f = gzip.open(dump_path, 'rb')
+    try:
+        # like loaddata it's all one transaction so deferred constraints (postgresql) are only checked at
+        # the end whatever order the models come in, and a failure leaves the database as it was
+        with transaction.atomic(using=using):
+            with connection.constraint_checks_disabled():
+                if clear:
+                    cursor = connection.cursor()
+                    for model in reversed(app_models):
+                        cursor.execute("DELETE FROM %s" % connection.ops.quote_name(model._meta.db_table))
+
+                # each header line starts a new group of lines for its model
+                headers_seen = [0]
+
+                def section(row):
+                    if isinstance(row, dict):
+                        headers_seen[0] += 1
+                    return headers_seen[0]
+
+                for _, rows in itertools.groupby((json.loads(x) for x in f), section):
+                    header = next(rows)
+                    loader = _ModelLoader(header, batch_size)
+                    for row in rows:
+                        loader.add(row)
+                    loader.flush()
+                    counts[header['model']] = loader.count
+
+            connection.check_constraints(table_names=[x._meta.db_table for x in app_models])
+            # loaded rows keep their ids so sequences have to be moved past them
+            sequence_sql = connection.ops.sequence_reset_sql(no_style(), app_models)
+            if sequence_sql:
+                cursor = connection.cursor()
+                for sql in sequence_sql:
+                    cursor.execute(sql)
+    except ValueError as e:
+        return dict(error=str(e), dump_path=dump_path)
+    finally:
+        f.close()
+
+    return dict(error=None, dump_path=dump_path, counts=counts, seconds=time.time() - start)
@@ -1,5 +1,6 @@
 from forms import ParameterTypes
 import sqlite3
+import re
 
 
 DEF_SQLITE_TYPES = {
@@ -111,12 +112,26 @@ class ResultInterface(object):
 OP_OP_DICT = dict(GE='>=', LE='<=', EQ='=', IN='IN')
 ESCAPED_TYPES = [ParameterTypes.STRING, ParameterTypes.URL, ParameterTypes.URL]
 
+#
+# Group formats made only of these conversions give the same text from sqlite's printf()
+# as from python's % operator so they can be computed in the SELECT
+#
+SQL_FORMAT_CONVERSIONS = {
+    's': [ParameterTypes.STRING, ParameterTypes.LABEL, ParameterTypes.URL],
+    'd': [ParameterTypes.INTEGER, ParameterTypes.FLOAT, ParameterTypes.BOOLEAN],
+    'f': [ParameterTypes.INTEGER, ParameterTypes.FLOAT],
+}
+SQL_FORMAT_REGEX = re.compile('%(.?)')
+SQL_HAS_PRINTF = sqlite3.sqlite_version_info >= (3, 8, 3)
+
 
 class ResultReadInterface(ResultInterface):
 
     def _setup_access(self):
         self.filters = []
         self.filter_clause = ""
+        self.view_plan = []
+        self.view_select = ""
 
     def _get_all_headers(self):
         return ",".join([x['name'] for x in self.headers])
@@ -160,8 +175,7 @@ class ResultReadInterface(ResultInterface):
         self.filters = []
         self.filter_clause = ""
 
-    def get_result_tuples(self, sort_terms=(), offset=0, limit=0):
-
+    def _get_sort_clause(self, sort_terms=(), offset=0, limit=0):
         sort_clause = ""
         if sort_terms:
             sort_clause = "ORDER BY " + ", ".join(['"%s" %s' % term for term in sort_terms])
@@ -169,6 +183,11 @@ class ResultReadInterface(ResultInterface):
             sort_clause += " LIMIT %d" % limit
         if offset:
             sort_clause += " OFFSET %d" % offset
+        return sort_clause
+
+    def get_result_tuples(self, sort_terms=(), offset=0, limit=0):
+
+        sort_clause = self._get_sort_clause(sort_terms, offset, limit)
 
         full_clause = "SELECT rowid,* from RESULT %s %s;" % (self.filter_clause,  sort_clause)
 
@@ -212,6 +231,89 @@ class ResultReadInterface(ResultInterface):
 
     def set_view_info(self, view_info):
         self.view_info = view_info
+        self._compile_view_info()
+
+    def _get_sql_group_format(self, fmt, group):
+        """
+        Returns a printf() expression computing the group's text in sqlite or None if
+        python has to do the formatting.
+        It gives NULL when any of the group is NULL since printf's text for those isn't what
+        python gives, interpret_view_tuple formats those from the group's values in python instead.
+        """
+        if not SQL_HAS_PRINTF or not isinstance(fmt, basestring) or fmt in FORMATTERS:
+            return None
+
+        conversions = [c for c in SQL_FORMAT_REGEX.findall(fmt) if c != '%']
+        if len(conversions) != len(group):
+            return None
+
+        for c, name in zip(conversions, group):
+            if self.header_dict[name]['kind'] not in SQL_FORMAT_CONVERSIONS.get(c, ()):
+                return None
+
+        return "CASE WHEN %s THEN NULL ELSE printf('%s', %s) END" % (
+            " OR ".join(['"%s" IS NULL' % name for name in group]),
+            fmt.replace("'", "''"), ", ".join(['"%s"' % name for name in group]))
+
+    def _compile_view_info(self):
+        """
+        Works out the columns a view needs so get_view_tuples only reads those and
+        where each view item finds its values in both full and view tuples
+        """
+        self.view_plan = []
+        self.view_select = ""
+        if not self.view_info:
+            return
+
+        columns = ['rowid']
+        projected = dict(rowid=0)
+
+        def add_column(expression):
+            if expression not in projected:
+                projected[expression] = len(columns)
+                columns.append(expression)
+            return projected[expression]
+
+        for view_item in self.view_info:
+            # combine info from the view and the data description to get the control info
+            info = dict(self.header_dict.get(view_item['name'],{}).items() + view_item.items())
+            group = view_item.get('group', None)
+            if group:
+                full_index = tuple([self.header_indicies[term] for term in group])
+                sql_format = self._get_sql_group_format(view_item.get('format', None), group)
+                if sql_format:
+                    view_index = add_column(sql_format)
+                    # the values too for formatting rows with NULLs in python
+                    raw_index = tuple([add_column('"%s"' % term) for term in group])
+                else:
+                    view_index = raw_index = tuple([add_column('"%s"' % term) for term in group])
+            else:
+                sql_format = None
+                full_index = self.header_indicies[view_item['name']]
+                view_index = raw_index = add_column('"%s"' % view_item['name'])
+
+            self.view_plan.append(dict(info=info, full_index=full_index, view_index=view_index,
+                                       raw_index=raw_index, sql_formatted=sql_format is not None))
+
+        self.view_select = ",".join(columns)
+
+    def get_view_tuples(self, sort_terms=(), offset=0, limit=0):
+        """
+        Like get_result_tuples but only reads the rowid and the columns used by the view.
+        The tuples must be interpreted with interpret_view_tuple
+        """
+        if not self.view_plan:
+            return self.get_result_tuples(sort_terms=sort_terms, offset=offset, limit=limit)
+
+        sort_clause = self._get_sort_clause(sort_terms, offset, limit)
+
+        full_clause = "SELECT %s from RESULT %s %s;" % (self.view_select, self.filter_clause,  sort_clause)
+
+        try:
+            self.cur.execute(full_clause)
+            return self.cur.fetchall()
+        except:
+            return ()
 
 
     def _get_formatted_item(self, x, value, for_csv=False):
@@ -249,16 +351,15 @@ class ResultReadInterface(ResultInterface):
         # Allow for a fancier interpretation of the data than normal
         #
         if self.view_info:
-            for view_item in self.view_info:
-                if view_item.get('group', None):
+            for plan in self.view_plan:
+                index = plan['full_index']
+                if isinstance(index, tuple):
                     # assemble the group items
-                    items = tuple([tup[self.header_indicies[term]] for term in view_item['group']])
+                    items = tuple([tup[x] for x in index])
                 else:
-                    items = tup[self.header_indicies[view_item['name']]]
+                    items = tup[index]
 
-                # combine info from the view and the data description to get the control info
-                info = dict(self.header_dict.get(view_item['name'],{}).items() + view_item.items())
-                term = self._get_formatted_item(info, items)
+                term = self._get_formatted_item(plan['info'], items, for_csv)
                 l.append(term)
         else:
             for idx, term in enumerate(tup):
@@ -270,6 +371,31 @@ class ResultReadInterface(ResultInterface):
         return tuple(l)
 
 
+    def interpret_view_tuple(self, tup, for_csv=False):
+        """
+        Like interpret_tuple but for the tuples returned by get_view_tuples
+        """
+        if not self.view_plan:
+            return self.interpret_tuple(tup, for_csv=for_csv)
+
+        l = []
+        for plan in self.view_plan:
+            index = plan['view_index']
+            if plan['sql_formatted']:
+                if tup[index] is not None:
+                    l.append(unicode(tup[index]))
+                    continue
+                # part of the group is NULL so format it like interpret_tuple would
+                index = plan['raw_index']
+
+            if isinstance(index, tuple):
+                items = tuple([tup[x] for x in index])
+            else:
+                items = tup[index]
+            l.append(self._get_formatted_item(plan['info'], items, for_csv))
+
+        return tuple(l)
+
     def get_result_dicts(self, sort_terms=(), offset=0, limit=0):
         return [self._tuple_to_dict(x) for x in self.get_result_tuples(sort_terms=sort_terms, offset=offset, limit=limit)]
 
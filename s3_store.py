@@ -0,0 +1,307 @@
+"""
+Storage for object folders in S3 (or anything that talks the S3 protocol).
+
+Settings:
+    FILE_S3_BUCKET        - the bucket object folders go in
+    FILE_S3_PREFIX        - optional prefix for all the keys
+    FILE_S3_ENDPOINT_URL  - optional, for S3 compatible services other than Amazon
+    FILE_S3_CACHE_ROOT    - local folder for the read-through cache
+                            (defaults to FILE_PERMANENT_DATA_ROOT/.s3_cache)
+    FILE_S3_CACHE_QUOTA   - bytes the cache can use before the least recently used copies go
+    FILE_S3_CACHE_CHECK_SECONDS - how long a cached copy is trusted before its ETag is checked
+                            against S3 again (0 checks every time)
+
+Each cached copy has a .s3meta file next to it with the ETag and size it was downloaded with
+so a copy gone stale because another host changed the object is downloaded again.
+
+Keys mirror the object folder layout so s3:foo.txt for group/kind/folder is the
+key group/kind/folder/foo.txt
+"""
+import json
+import os
+import os.path
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+from file_store import insure_folder, get_path_with_folders, retry_on_missing_folder
+
+S3_MULTIPART_THRESHOLD = 16*1024*1024
+S3_MULTIPART_CHUNK_SIZE = 16*1024*1024
+S3_MAX_CONCURRENCY = 8
+S3_READ_SIZE = 1024*1024
+S3_CACHE_QUOTA = 10*1024*1024*1024
+S3_CACHE_CHECK_SECONDS = 60
+S3_CACHE_META_SUFFIX = '.s3meta'
+# copies used this recently are never evicted since someone may be about to open them
+S3_CACHE_EVICT_GRACE = 60
+
+# the cache's size as this process last saw it plus what it has added since, so the cache
+# only has to be walked when that says it might be over the quota
+_s3_cache_sizes = {}
+_s3_cache_sizes_lock = threading.Lock()
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    One client for the process. boto3 clients are thread safe and keep a pool of connections
+    so reusing it saves a TLS handshake per request.
+    """
+    global _s3_client
+    assert boto3, "boto3 is needed for S3 storage"
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3',
+                                      endpoint_url=getattr(settings, 'FILE_S3_ENDPOINT_URL', None),
+                                      config=Config(max_pool_connections=S3_MAX_CONCURRENCY*2))
+    return _s3_client
+
+
+def get_s3_transfer_config():
+    return TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                          multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+                          max_concurrency=S3_MAX_CONCURRENCY,
+                          use_threads=True)
+
+
+def get_s3_bucket():
+    return settings.FILE_S3_BUCKET
+
+
+def get_s3_key(filename, group, kind=None, folder=None):
+    parts = [getattr(settings, 'FILE_S3_PREFIX', None), group, kind, folder, filename]
+    return "/".join([x for x in parts if x])
+
+
+def get_s3_cache_root():
+    return getattr(settings, 'FILE_S3_CACHE_ROOT', None) or os.path.join(settings.FILE_PERMANENT_DATA_ROOT, '.s3_cache')
+
+
+def get_s3_cache_path(key):
+    return os.path.join(get_s3_cache_root(), *key.split('/'))
+
+
+def get_s3_cache_quota():
+    return getattr(settings, 'FILE_S3_CACHE_QUOTA', S3_CACHE_QUOTA)
+
+
+def _read_s3_cache_meta(cache_path):
+    try:
+        with open(cache_path + S3_CACHE_META_SUFFIX, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_s3_cache_meta(cache_path, etag, size):
+    meta_path = cache_path + S3_CACHE_META_SUFFIX
+    tmp_path = "%s.tmp-%s" % (meta_path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        json.dump(dict(etag=etag, size=size, checked_on=time.time()), f)
+    os.rename(tmp_path, meta_path)
+
+
+def _add_s3_cache_size(size):
+    root = get_s3_cache_root()
+    with _s3_cache_sizes_lock:
+        if root in _s3_cache_sizes:
+            _s3_cache_sizes[root] = max(0, _s3_cache_sizes[root] + size)
+
+
+def _remove_cached_copy(key):
+    cache_path = get_s3_cache_path(key)
+    if os.path.exists(cache_path):
+        _add_s3_cache_size(-os.path.getsize(cache_path))
+    for path in (cache_path, cache_path + S3_CACHE_META_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def s3_key_exists(key):
+    try:
+        get_s3_client().head_object(Bucket=get_s3_bucket(), Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def list_s3_folder(prefix):
+    """
+    The set of names directly under prefix
+    """
+    names = set()
+    prefix = prefix + '/' if prefix else ''
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=get_s3_bucket(), Prefix=prefix, Delimiter='/'):
+        for item in page.get('Contents', ()):
+            names.add(item['Key'][len(prefix):])
+    return names
+
+
+def upload_file_to_s3(src, key):
+    """
+    Big files go up as a multipart upload with the parts sent in parallel
+    """
+    get_s3_client().upload_file(src, get_s3_bucket(), key, Config=get_s3_transfer_config())
+    _remove_cached_copy(key)  # stale now
+    return key
+
+
+def open_s3_file(key, start=None, end=None):
+    """
+    Returns a file-like object streaming the object's data. start and end (inclusive)
+    ask for just that range of bytes.
+    """
+    kwargs = dict(Bucket=get_s3_bucket(), Key=key)
+    if start is not None or end is not None:
+        kwargs['Range'] = "bytes=%s-%s" % (start or 0, "" if end is None else end)
+    return get_s3_client().get_object(**kwargs)['Body']
+
+
+def read_s3_file_in_chunks(key, chunk_size=S3_READ_SIZE):
+    body = open_s3_file(key)
+    try:
+        while True:
+            data = body.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        body.close()
+
+
+def _walk_s3_cache(root):
+    files = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in file_names:
+            if name.endswith(S3_CACHE_META_SUFFIX) or '.tmp-' in name:
+                continue
+            file_path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            # hits touch the mtime since access times aren't updated on noatime mounts
+            files.append((max(st.st_atime, st.st_mtime), st.st_size, file_path))
+    return files
+
+
+def enforce_s3_cache_quota(reserve=0):
+    """
+    Remove the least recently used cached copies until there is room for reserve more bytes.
+    The cache is only walked when the size this process knows of says it might be over the quota.
+    Copies used in the last S3_CACHE_EVICT_GRACE seconds are left alone.
+    Returns the number of bytes freed.
+    """
+    root = get_s3_cache_root()
+    quota = get_s3_cache_quota()
+    with _s3_cache_sizes_lock:
+        known_size = _s3_cache_sizes.get(root)
+        if known_size is not None and known_size + reserve <= quota:
+            _s3_cache_sizes[root] = known_size + reserve
+            return 0
+
+        files = _walk_s3_cache(root)
+        total = sum(size for used, size, file_path in files)
+        freed = 0
+        now = time.time()
+        for used, size, file_path in sorted(files):
+            if total + reserve - freed <= quota:
+                break
+            if now - used < S3_CACHE_EVICT_GRACE:
+                break  # everything from here on is newer
+            for path in (file_path, file_path + S3_CACHE_META_SUFFIX):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            freed += size
+        _s3_cache_sizes[root] = total - freed + reserve
+    return freed
+
+
+@retry_on_missing_folder
+def get_s3_file_local_path(key, refresh=False):
+    """
+    The path of a local copy of the object, downloading it into the cache if we don't have it
+    or the object's ETag or size no longer match the copy we have.
+    Downloads of big objects are done as parallel ranged gets.
+    """
+    cache_path = get_s3_cache_path(key)
+    meta = None if refresh else _read_s3_cache_meta(cache_path)
+    if meta is not None and os.path.exists(cache_path):
+        check_seconds = getattr(settings, 'FILE_S3_CACHE_CHECK_SECONDS', S3_CACHE_CHECK_SECONDS)
+        if time.time() - meta['checked_on'] < check_seconds:
+            os.utime(cache_path, None)
+            return cache_path
+        head = get_s3_client().head_object(Bucket=get_s3_bucket(), Key=key)
+        if head['ETag'] == meta['etag'] and head['ContentLength'] == meta['size'] == os.path.getsize(cache_path):
+            _write_s3_cache_meta(cache_path, meta['etag'], meta['size'])
+            os.utime(cache_path, None)
+            return cache_path
+    else:
+        head = get_s3_client().head_object(Bucket=get_s3_bucket(), Key=key)
+
+    enforce_s3_cache_quota(reserve=head['ContentLength'])
+    insure_folder(os.path.dirname(cache_path))
+    tmp_path = "%s.tmp-%s" % (cache_path, uuid.uuid4().hex)
+    try:
+        get_s3_client().download_file(get_s3_bucket(), key, tmp_path, Config=get_s3_transfer_config())
+        if os.path.getsize(tmp_path) != head['ContentLength']:
+            raise IOError("%s changed while it was downloaded" % key)
+        if os.path.exists(cache_path):
+            _add_s3_cache_size(-os.path.getsize(cache_path))  # the stale copy being replaced
+        os.rename(tmp_path, cache_path)
+    except:
+        _add_s3_cache_size(-head['ContentLength'])
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _write_s3_cache_meta(cache_path, head['ETag'], head['ContentLength'])
+    return cache_path
+
+
+def delete_s3_file(key):
+    get_s3_client().delete_object(Bucket=get_s3_bucket(), Key=key)
+    _remove_cached_copy(key)
+
+
+def upload_object_folder_to_s3(group, kind, folder, remove_local=False, thread_count=S3_MAX_CONCURRENCY):
+    """
+    Copy every file in an object folder up to S3, a few files at a time.
+    With remove_local the local files are removed once they are all up.
+    Returns the list of keys.
+    """
+    path = get_path_with_folders(settings.FILE_PERMANENT_DATA_ROOT, group, kind, folder, create=False)
+    names = [x for x in os.listdir(path) if os.path.isfile(os.path.join(path, x))]
+
+    def upload(name):
+        return upload_file_to_s3(os.path.join(path, name), get_s3_key(name, group, kind, folder))
+
+    pool = ThreadPool(max(1, min(thread_count, len(names))))
+    try:
+        keys = pool.map(upload, names)
+    finally:
+        pool.close()
+        pool.join()
+
+    if remove_local:
+        for name in names:
+            os.remove(os.path.join(path, name))
+    return keys
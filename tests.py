@@ -1,14 +1,41 @@
 # coding=utf-8
-from django.test import TestCase
-from django.db import models
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import models, connection, transaction
 from django.contrib.auth.models import User
 from models import AnnotationNote, NoteHistory
-from models import WorkflowItem, WorkflowItemStatus
-
-from forms import ParameterTypes
+from models import WorkflowItem, WorkflowItemStatus, WorkflowItemCurrentState
+from models import InboxFileStoreTrackFile, InboxFileStoreTrackItem
+from models import ChildClassViewer, UUIDField, BinaryUUIDField
+
+from forms import ParameterTypes, get_form_class_for_class
+from form_utils import create_form_class_with_parameter_list
+from dj_extras.utils import bulk_get_or_create_or_update, get_or_create_or_update
+from dj_extras.utils import get_or_none_cached, start_lookup_memo, end_lookup_memo, get_lookup_cache
+from orm_dump import dump_app_data, load_app_data
+from dj_extras import utils
 import os
 
 from result_table import create_result_reader, create_result_writer
+import file_store
+import history_archive
+import gzip
+import hashlib
+import shutil
+import tempfile
+import time
+import unittest
+import uuid
+from StringIO import StringIO
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    boto3 = None
 
 class ModelToAnnotate(models.Model):
     foo = models.IntegerField(default=10)
@@ -20,6 +47,8 @@ class ModelToAnnotate(models.Model):
 class TestNoteHistory(NoteHistory):
     note_object = models.ForeignKey('TestNote')
 
+    history_parent_field = 'note_object'
+
 
 class TestNote(AnnotationNote):
     base = models.ForeignKey(ModelToAnnotate)
@@ -33,6 +62,9 @@ class TestNote(AnnotationNote):
     def get_recent_items(self, count):
         return self.testnotehistory_set.all().order_by('-changed_on')[0:count]
 
+    def build_history(self, user, txt):
+        return TestNoteHistory(changed_by=user, note_object=self, old_txt = self.note_txt)
+
 
 class TestWorkFlowItem(WorkflowItem):
     base_item = models.ForeignKey(ModelToAnnotate)
@@ -45,6 +77,89 @@ class TestWorkFlowStatus(WorkflowItemStatus):
     workflow_item = models.ForeignKey(TestWorkFlowItem)
 
 
+class TestStateWorkFlowItem(WorkflowItemCurrentState):
+    def get_tracking_manager(self):
+        return TestStateWorkFlowStatus.objects
+
+class TestStateWorkFlowStatus(WorkflowItemStatus):
+    workflow_item = models.ForeignKey(TestStateWorkFlowItem)
+
+
+class TestInboxFile(InboxFileStoreTrackFile):
+    pass
+
+class TestInboxItem(InboxFileStoreTrackItem):
+    file = models.ForeignKey(TestInboxFile)
+
+
+class TestViewedItem(ChildClassViewer):
+    label = models.CharField(max_length=20)
+
+class TestViewedThing(TestViewedItem):
+    base = models.ForeignKey(ModelToAnnotate)
+
+class TestViewedOther(TestViewedItem):
+    size = models.IntegerField(default=0)
+
+
+class ChildClassViewerTest(TestCase):
+
+    def test_get_children(self):
+        bo = ModelToAnnotate.objects.create(foo=20)
+        for idx in range(30):
+            if idx % 3 == 0:
+                TestViewedThing.objects.create(label="t%d" % idx, base=bo)
+            elif idx % 3 == 1:
+                TestViewedOther.objects.create(label="o%d" % idx, size=idx)
+            else:
+                TestViewedItem.objects.create(label="i%d" % idx)
+
+        with self.assertNumQueries(3):
+            children = TestViewedItem.objects.order_by('-pk').as_children('base')
+            self.assertEqual([x.label for x in children], ['%s%d' % ('toi'[x % 3], x) for x in reversed(range(30))])
+            self.assertEqual([type(x) for x in children[-3:]], [TestViewedItem, TestViewedOther, TestViewedThing])
+            self.assertEqual(children[-1].base.foo, 20)
+            self.assertEqual(children[-2].size, 1)
+
+        # base is only followed for the child class that has it
+        with CaptureQueriesContext(connection) as queries:
+            TestViewedItem.objects.as_children('base')
+        other_table = TestViewedOther._meta.db_table
+        base_table = ModelToAnnotate._meta.db_table
+        self.assertEqual([base_table in x['sql'] for x in queries.captured_queries if 'FROM "%s"' % other_table in x['sql']],
+                         [False])
+        self.assertEqual(len([x for x in queries.captured_queries if base_table in x['sql']]), 1)
+        self.assertRaises(AssertionError, TestViewedItem.objects.as_children, 'no_such_thing')
+
+
+class TestUUIDModel(models.Model):
+    char_id = UUIDField()
+    binary_id = BinaryUUIDField(time_ordered=True, db_index=True)
+
+
+class UUIDFieldTest(TestCase):
+
+    def test_uuid_fields(self):
+        made = TestUUIDModel.objects.create()
+        self.assertEqual(len(made.char_id), 36)
+        self.assertEqual(len(made.binary_id), 36)
+
+        objs = [TestUUIDModel() for x in range(20)]
+        TestUUIDModel.objects.bulk_create(objs)
+        ids = [x.binary_id for x in objs]
+        self.assertEqual(len(set(ids)), 20)
+        # the time comes first so they sort in the order they were made (to the millisecond)
+        self.assertEqual([x[:13] for x in ids], sorted([x[:13] for x in ids]))
+
+        self.assertEqual(TestUUIDModel.objects.get(binary_id=ids[3]).char_id, objs[3].char_id)
+        self.assertEqual(TestUUIDModel.objects.filter(binary_id__in=ids[0:5]).count(), 5)
+        self.assertEqual(TestUUIDModel.objects.get(char_id=made.char_id).binary_id, made.binary_id)
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT length(binary_id) FROM %s" % TestUUIDModel._meta.db_table)
+        self.assertEqual(set(x[0] for x in cursor.fetchall()), set([16]))
+
+
 class NoteTest(TestCase):
     fixtures = ['users.json']
 
@@ -69,6 +184,73 @@ class NoteTest(TestCase):
             self.assertEqual(hl[1].changed_by, u)
             self.assertEqual("MORE", hl[1].old_txt)
 
+    def test_bulk_update_notes(self):
+        bo = ModelToAnnotate.objects.create(foo=20)
+        u = User.objects.all()[0]
+        u2 = User.objects.all()[1]
+        notes = [TestNote.objects.create(base=bo, note_txt="Note %d" % x, created_by=u, changed_by=u) for x in range(400)]
+
+        pairs = [(n, "New %d" % idx if idx % 4 else n.note_txt) for idx, n in enumerate(notes)]
+        with self.assertNumQueries(5): # 2 savepoints, 2 inserts of sqlite's batch size and 1 update
+            changed = TestNote.bulk_update_notes(pairs, u2)
+        self.assertEqual(len(changed), 300)
+
+        self.assertEqual(TestNoteHistory.objects.count(), 300)
+        self.assertEqual(TestNote.objects.filter(changed_by=u2).count(), 300)
+        self.assertEqual(TestNote.objects.get(pk=notes[5].pk).note_txt, "New 5")
+        self.assertEqual(TestNote.objects.get(pk=notes[4].pk).note_txt, "Note 4")
+        self.assertEqual(notes[5].testnotehistory_set.get().old_txt, "Note 5")
+
+    def test_archive_history(self):
+        bo = ModelToAnnotate.objects.create(foo=20)
+        u = User.objects.all()[0]
+        notes = [TestNote.objects.create(base=bo, note_txt="Start", created_by=u, changed_by=u) for x in range(3)]
+        for idx, note in enumerate(notes):
+            for x in range(idx + 2):
+                note.update(u, "Text %d" % x)
+        before = [[h.pk for h in TestNoteHistory.get_history(n)] for n in notes]
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(HISTORY_ARCHIVE_ROOT=tmp_dir):
+                # as if a run died after writing the archive but before the delete
+                older = TestNoteHistory.objects.filter(note_object=notes[1]).exclude(pk=before[1][0])
+                history_archive._write_archive_rows(TestNoteHistory, list(older),
+                                                    history_archive._get_parent_field(TestNoteHistory))
+                call_command('archive_history', 'dj_extras.TestNoteHistory', days=-1, stdout=StringIO())
+                # only the latest for each note is left in the table
+                self.assertEqual(TestNoteHistory.objects.count(), 3)
+                self.assertEqual([[h.pk for h in TestNoteHistory.get_history(n)] for n in notes], before)
+                self.assertEqual(TestNoteHistory.get_history(notes[2])[-1].old_txt, "Start")
+                # any kind of pk gets a bucket
+                self.assertTrue(history_archive.get_archive_path(TestNoteHistory, uuid.uuid4().hex).endswith('.jsonl.gz'))
+                self.assertEqual(history_archive.read_archived_history(TestNoteHistory, uuid.uuid4().hex), [])
+                archived = history_archive.read_archived_history(TestNoteHistory, notes[1].pk)
+                self.assertEqual(sorted(x.pk for x in archived), sorted(before[1][1:]))
+                self.assertEqual(len(TestNoteHistory.get_history(notes[2], include_archive=False)), 1)
+                self.assertEqual(TestNoteHistory.archive_history(timezone.now()), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_history_users_query_count(self):
+        bo = ModelToAnnotate.objects.create(foo=20)
+        u = User.objects.all()[0]
+        u2 = User.objects.all()[1]
+        tn = TestNote.objects.create(base=bo, note_txt="Start", created_by=u, changed_by=u)
+        for x in range(5):
+            tn.update(u if x % 2 else u2, "Text %d" % x)
+
+        with self.assertNumQueries(1):
+            names = [unicode(h) for h in tn.testnotehistory_set.all()]
+        self.assertEqual(len(names), 5)
+        with self.assertNumQueries(1):
+            notes = [(n.created_by.username, n.changed_by.username) for n in TestNote.objects.all()]
+        self.assertEqual(notes, [(u.username, u2.username)])
+        with self.assertNumQueries(1):
+            h = TestNoteHistory.objects.with_users(only_username=True)[0]
+            self.assertTrue(h.changed_by.username)
+        self.assertEqual(h.changed_by.email, h.changed_by.__class__.objects.get(pk=h.changed_by_id).email)
+
 class WorkflowTest(TestCase):
     fixtures = ['users.json']
 
@@ -91,6 +273,82 @@ class WorkflowTest(TestCase):
         
         self.assertEqual(tw.base_item,wi)
 
+    def test_current_trackers(self):
+        wi = ModelToAnnotate.objects.create(foo=30)
+        u = User.objects.all()[0]
+        u2 = User.objects.all()[1]
+        for idx in range(5):
+            tw = TestWorkFlowItem.objects.create(name="Item%d" % idx, base_item=wi, display_name="Item %d" % idx,
+                                                 priority=idx)
+            for state in range(idx):
+                tw.update(u if state % 2 else u2, state + 1)
+
+        with self.assertNumQueries(2):
+            items = list(TestWorkFlowItem.objects.all().with_current_trackers())
+            self.assertEqual([x.get_current_state() for x in items], [-1, 1, 2, 3, 4])
+            self.assertEqual([x.get_info_html().split(' on ')[0] for x in items],
+                             ['', '- by %s' % u2.username, '- by %s' % u.username,
+                              '- by %s' % u2.username, '- by %s' % u.username])
+
+        items[0].update(u, 7)
+        self.assertEqual(items[0].get_current_state(), 7)
+
+    def test_current_state_columns(self):
+        u = User.objects.all()[0]
+        items = [TestStateWorkFlowItem.objects.create(name="Item%d" % x, display_name="Item %d" % x) for x in range(3)]
+        self.assertEqual(items[0].get_current_state(), -1)
+        items[0].update(u, 1)
+        items[1].update(u, 2)
+        items[1].update(u, 1)
+        self.assertEqual(items[1].get_current_state(), 1)
+        self.assertTrue(items[1].get_info_html().startswith('- by %s' % u.username))
+        self.assertEqual(TestStateWorkFlowItem.objects.filter(current_state=1).count(), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(len([x.get_info_html() for x in TestStateWorkFlowItem.objects.all() if x.get_info_html()]), 2)
+
+        TestStateWorkFlowItem.objects.update(current_state=-1, current_changed_on=None, current_changed_by=None)
+        call_command('rebuild_workflow_current_state', 'dj_extras.TestStateWorkFlowItem', stdout=StringIO())
+        self.assertEqual(sorted(TestStateWorkFlowItem.objects.values_list('current_state', flat=True)), [-1, 1, 1])
+        self.assertEqual(TestStateWorkFlowItem.rebuild_current_state(), 0)
+
+    def test_current_state_user_deleted(self):
+        u = User.objects.create(username="leaving")
+        item = TestStateWorkFlowItem.objects.create(name="Item", display_name="Item")
+        item.update(u, 2)
+        u.delete()
+        # the item outlives the user who last changed it
+        item = TestStateWorkFlowItem.objects.get(pk=item.pk)
+        self.assertEqual(item.current_changed_by_id, None)
+
+
+class InboxTrackingTest(TestCase):
+    fixtures = ['users.json']
+
+    def test_sync(self):
+        u = User.objects.all()[0]
+        names = ['file%04d.txt' % x for x in range(1200)]
+        with self.assertNumQueries(6): # 1 select and 5 inserts of sqlite's batch size
+            result = TestInboxFile.sync_inbox_files('lab', names, u)
+        self.assertEqual(len(result['created']), 1200)
+
+        result = TestInboxFile.sync_inbox_files('lab', names[1:] + ['new.txt'], u)
+        self.assertEqual(result, dict(created=['new.txt'], missing=[names[0]]))
+        self.assertEqual(TestInboxFile.objects.filter(folder='lab').count(), 1201)
+
+        files = list(TestInboxFile.objects.filter(folder='lab')[0:10])
+        self.assertEqual(TestInboxItem.sync_inbox_items(dict((f, ['s1', 's2']) for f in files), u), 20)
+        self.assertEqual(TestInboxItem.sync_inbox_items(dict((f, ['s2', 's3']) for f in files), u), 10)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(TestInboxItem.mark_items_used(files, u, items=['s1', 's3']), 20)
+        self.assertEqual(TestInboxItem.mark_items_used(files, u), 10)
+        self.assertEqual(TestInboxItem.objects.filter(used=False).count(), 0)
+
+        # with both lists each gets half the batch, here 5 chunks of 2 files times 2 chunks of items
+        with self.assertNumQueries(10):
+            self.assertEqual(TestInboxItem.mark_items_used(files, u, items=['s1', 's2', 's3'], used=False,
+                                                           batch_size=4), 30)
+
 
 class ResultTableTest(TestCase):
 
@@ -147,18 +405,565 @@ class ResultTableTest(TestCase):
 
         rr.set_view_info(view)
 
-        headers =  rr.get_display_headers()
+        display_headers = rr.get_display_headers()
 
-        self.assertEqual([('pair1', 'Pair 1'), ('stringcol3', u'String C3'), ('textcol4', u'Long String C4')], headers)
+        self.assertEqual([('pair1', 'Pair 1'), ('stringcol3', u'String C3'), ('textcol4', u'Long String C4')], display_headers)
 
 
         tup = rr.get_result_tuple(1)
         interp  = rr.interpret_tuple(tup)
         self.assertEqual((u'2 -> 2.300000', u'-> E\xe9aya -<', u'm is 2 from func:'), interp)
 
+        # The view tuples only carry the rowid and the columns the view uses (a group's values follow its text)
+        vt = rr.get_view_tuples( (('intcol1', 'ASC'),), limit=2, offset=0)
+        self.assertEqual(vt, [(1, u'2 -> 2.300000', 2, 2.3, u'E\xe9aya', u'Num is 2'),
+                              (2, u'9 -> 2.300000', 9, 2.3, u'Mon Frere', u'Num is 9')])
+        self.assertEqual(rr.interpret_view_tuple(vt[0]), interp)
+
         rr.close()
         os.unlink('tmptest$$.db')
 
+        # NULLs in a group come out the way python formats them, not as sqlite's printf would
+        rw = create_result_writer(TEST_FILE, headers)
+        index = rw.add_result(dict(intcol1=3, floatcol2=1.5, stringcol3=None, textcol4=u'Num is 3'))
+        rw.close()
+        rr = create_result_reader(TEST_FILE, headers)
+        rr.set_view_info([dict(name='pair2', group=('stringcol3', 'textcol4'), format=u'%s / %s', display_name='Pair 2')])
+        vt = rr.get_view_tuples()
+        full = rr.interpret_tuple(rr.get_result_tuple(index))
+        rr.get_result_tuple = None  # formatted from the view tuple without reading the row again
+        self.assertEqual(rr.interpret_view_tuple(vt[0]), (u'None / Num is 3',))
+        self.assertEqual(rr.interpret_view_tuple(vt[0]), full)
+        rr.close()
+        os.unlink(TEST_FILE)
+
+
+class FileStoreTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_digests(self):
+        paths = [self.write_file('f%d.txt' % x, 'data %d ' % x * (x * 5000)) for x in range(5)]
+        expected = dict((p, hashlib.sha256(open(p, 'rb').read()).hexdigest()) for p in paths)
+
+        self.assertEqual(file_store.get_sha256_digests_for_paths(paths), expected)
+        for p in paths:
+            self.assertEqual(file_store.get_sha256_digest_for_path(p), expected[p])
+            self.assertEqual(file_store.get_sha256_digest_for_path(p, use_cache=False), expected[p])
+
+        # A changed file gets a new key so it is read again
+        os.unlink(paths[1])
+        self.write_file('f1.txt', 'something else')
+        self.assertEqual(file_store.get_sha256_digest_for_path(paths[1]), hashlib.sha256('something else').hexdigest())
+
+        # only the most recently used are kept in memory
+        cache = file_store.DigestCache(size=2)
+        for x in range(3):
+            cache.set((0, x, 0, 0), 'd%d' % x)
+        cache.get((0, 1, 0, 0))
+        cache.set((0, 3, 0, 0), 'd3')
+        self.assertEqual([cache.get((0, x, 0, 0)) for x in range(4)], [None, 'd1', None, 'd3'])
+
+
+    def test_content_store(self):
+        src = self.write_file('big.txt', 'shared data ' * 10000)
+        with override_settings(FILE_PERMANENT_DATA_ROOT=os.path.join(self.tmp_dir, 'perm'),
+                               FILE_CONTENT_STORE_ROOT=os.path.join(self.tmp_dir, 'store')):
+            for folder in ('obj1', 'obj2'):
+                file_store.insure_file_in_object_folder(src, file_store.FileStoreLocations.FILE_SYSTEM,
+                                                        'grp', 'kind', folder)
+            p1 = file_store.get_object_folder_file_path('big.txt', 'grp', 'kind', 'obj1')
+            p2 = file_store.get_object_folder_file_path('big.txt', 'grp', 'kind', 'obj2')
+            self.assertTrue(os.path.samefile(p1, p2))
+            digest = file_store.get_sha256_digest_for_path(src)
+            self.assertEqual(file_store.get_content_reference_count(digest), 2)
+            self.assertEqual(file_store.collect_content_store_garbage(min_age=0), (0, 0))
+            self.assertEqual(os.stat(p1).st_mode & 0o777, file_store.STORED_FILE_MODE)
+
+            # putting other content there replaces the link rather than writing over the shared copy
+            os.mkdir(os.path.join(self.tmp_dir, 'new'))
+            other = self.write_file(os.path.join('new', 'big.txt'), 'other data')
+            with override_settings(FILE_CONTENT_STORE_ROOT=None):
+                file_store.insure_file_in_object_folder(other, file_store.FileStoreLocations.FILE_SYSTEM,
+                                                        'grp', 'kind', 'obj1')
+            self.assertEqual(open(p1, 'rb').read(), 'other data')
+            self.assertEqual(open(p2, 'rb').read(), 'shared data ' * 10000)
+            self.assertEqual(file_store.get_content_reference_count(digest), 1)
+
+            os.remove(p1)
+            os.remove(p2)
+            # files whose links just changed are left in case they are about to be linked
+            self.assertEqual(file_store.collect_content_store_garbage(), (0, 0))
+            self.assertEqual(file_store.collect_content_store_garbage(min_age=0), (1, os.path.getsize(src)))
+            self.assertEqual(file_store.get_content_reference_count(digest), 0)
+
+    def test_removed_folder_made_again(self):
+        src = self.write_file('a.txt', 'a')
+        perm = os.path.join(self.tmp_dir, 'perm')
+        with override_settings(FILE_PERMANENT_DATA_ROOT=perm):
+            for x in range(2):
+                file_store.insure_file_in_object_folder(src, file_store.FileStoreLocations.FILE_SYSTEM,
+                                                        'grp', 'kind', 'obj')
+                self.assertEqual(open(file_store.get_object_folder_file_path('a.txt', 'grp', 'kind', 'obj')).read(), 'a')
+                shutil.rmtree(perm)
+
+    def test_inbox_file_list(self):
+        with override_settings(FILE_INBOX_DATA_ROOT=self.tmp_dir):
+            for idx, name in enumerate(['a.txt', 'b.csv', 'c.txt']):
+                path = self.write_file(name, name)
+                os.utime(path, (1000 + idx, 1000 + idx))
+
+            self.assertEqual(file_store.get_inbox_file_list(), ['c.txt', 'b.csv', 'a.txt'])
+            self.assertEqual(file_store.get_inbox_file_list(extensions=['txt']), ['c.txt', 'a.txt'])
+            self.assertEqual(file_store.get_inbox_file_list(offset=1, limit=1), ['b.csv'])
+            self.assertEqual(file_store.get_inbox_file_count(extensions=['csv']), 1)
+
+            self.write_file('d.txt', 'd')
+            os.remove(os.path.join(self.tmp_dir, 'a.txt'))
+            self.assertEqual(file_store.get_inbox_file_list(extensions=['txt']), ['d.txt', 'c.txt'])
+
+            # files written in place keep their place until the stats are too old to trust
+            with open(os.path.join(self.tmp_dir, 'b.csv'), 'ab') as f:
+                f.write('more')
+            os.utime(os.path.join(self.tmp_dir, 'd.txt'), (1500, 1500))
+            self.write_file('e.dat', 'e')
+            os.utime(os.path.join(self.tmp_dir, 'e.dat'), (1400, 1400))
+            self.assertEqual(file_store.get_inbox_file_list(), ['d.txt', 'e.dat', 'c.txt', 'b.csv'])
+            max_age = file_store.INBOX_SNAPSHOT_MAX_AGE
+            file_store.INBOX_SNAPSHOT_MAX_AGE = 0
+            try:
+                self.assertEqual(file_store.get_inbox_file_list(), ['b.csv', 'd.txt', 'e.dat', 'c.txt'])
+            finally:
+                file_store.INBOX_SNAPSHOT_MAX_AGE = max_age
+
+    def test_inbox_snapshot_reuse(self):
+        scans = []
+        scan_entries = file_store.InboxSnapshot._scan_entries
+        def counting_scan(snapshot, known):
+            scans.append(len(known))
+            return scan_entries(snapshot, known)
+
+        file_store.InboxSnapshot._scan_entries = counting_scan
+        try:
+            with override_settings(FILE_INBOX_DATA_ROOT=self.tmp_dir):
+                os.mkdir(os.path.join(self.tmp_dir, 'grp'))
+                for name in ('a.txt', 'b.txt'):
+                    self.write_file(os.path.join('grp', name), name)
+                # a folder that changed well before the scan can't change again unnoticed
+                dir_path = os.path.join(self.tmp_dir, 'grp')
+                os.utime(dir_path, (time.time() - 100, time.time() - 100))
+                self.assertEqual(len(file_store.get_inbox_file_list('grp')), 2)
+                self.assertEqual(file_store.get_inbox_file_count('grp', extensions=['txt']), 2)
+                self.assertEqual(scans, [0])
+
+                # a changed folder is rescanned, only the new name is stat'ed
+                self.write_file(os.path.join('grp', 'c.txt'), 'c')
+                os.utime(dir_path, (time.time() - 50, time.time() - 50))
+                self.assertEqual(len(file_store.get_inbox_file_list('grp')), 3)
+                self.assertEqual(scans, [0, 2])
+        finally:
+            file_store.InboxSnapshot._scan_entries = scan_entries
+
+    def test_file_upload(self):
+        data = 'uploaded ' * 1000
+        upload = SimpleUploadedFile('up.txt', data)
+        with override_settings(FILE_INBOX_DATA_ROOT=self.tmp_dir):
+            info = file_store.store_django_file_upload(upload, 'grp', fsync=True)
+            self.assertEqual(info['path'], file_store.get_inbox_file_path('up.txt', 'grp'))
+            self.assertEqual(info['size'], len(data))
+            self.assertEqual(info['digest'], hashlib.sha256(data).hexdigest())
+            self.assertEqual(open(info['path'], 'rb').read(), data)
+            self.assertEqual(file_store.get_inbox_file_list('grp'), ['up.txt'])
+
+    def test_paths_exist(self):
+        fs_path = self.write_file('plain.txt', 'plain')
+        with override_settings(FILE_INBOX_DATA_ROOT=os.path.join(self.tmp_dir, 'inbox'),
+                               FILE_PERMANENT_DATA_ROOT=os.path.join(self.tmp_dir, 'perm')):
+            self.assertFalse(file_store.path_exists('object:x.txt', 'grp', 'kind', 'obj'))
+            # Just asking doesn't make the folders
+            self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'perm')))
+
+            open(file_store.get_object_folder_file_path('x.txt', 'grp', 'kind', 'obj'), 'w').close()
+            open(file_store.get_inbox_file_path('in.txt', 'grp'), 'w').close()
+            paths = ['object:x.txt', 'object:y.txt', 'inbox:in.txt', 'inbox:out.txt', fs_path, 'file:' + fs_path + '.no']
+            self.assertEqual(file_store.paths_exist(paths, 'grp', 'kind', 'obj'), [True, False, True, False, True, False])
+            self.assertTrue(file_store.path_exists('object:x.txt', 'grp', 'kind', 'obj'))
+
+    def test_ingest_inbox_files(self):
+        with override_settings(FILE_INBOX_DATA_ROOT=os.path.join(self.tmp_dir, 'inbox'),
+                               FILE_PERMANENT_DATA_ROOT=os.path.join(self.tmp_dir, 'perm')):
+            names = ['in%d.txt' % x for x in range(10)]
+            for name in names:
+                open(file_store.get_inbox_file_path(name, 'grp'), 'wb').write(name * 100)
+            done = []
+            results = file_store.ingest_inbox_files(names + ['missing.txt'], 'grp', 'kind', 'obj',
+                                                    progress=lambda d, t, r: done.append(d))
+
+            self.assertEqual(done, range(1, 12))
+            self.assertEqual([x['filename'] for x in results], names + ['missing.txt'])
+            self.assertEqual([x['error'] is None for x in results], [True] * 10 + [False])
+            self.assertEqual(results[3]['digest'], hashlib.sha256('in3.txt' * 100).hexdigest())
+            self.assertEqual(file_store.get_inbox_file_list('grp'), [])
+            self.assertTrue(all(file_store.paths_exist(['object:' + x for x in names], 'grp', 'kind', 'obj')))
+
+            # a name given twice gets a result (and a progress call) each time
+            open(file_store.get_inbox_file_path('twice.txt', 'grp'), 'wb').write('twice')
+            done = []
+            results = file_store.ingest_inbox_files(['twice.txt', 'twice.txt'], 'grp', 'kind', 'obj', thread_count=1,
+                                                    progress=lambda d, t, r: done.append((d, t)))
+            self.assertEqual(done, [(1, 2), (2, 2)])
+            self.assertEqual([x['error'] is None for x in results], [True, False])
+
+            open(file_store.get_inbox_file_path('kept.txt', 'grp'), 'wb').write('kept')
+            os.mkdir(file_store.get_inbox_file_path('subdir', 'grp'))
+            call_command('ingest_inbox_files', 'grp', 'kind', 'obj2', keep=True, stdout=StringIO())
+            self.assertEqual(sorted(file_store.get_inbox_file_list('grp')), ['kept.txt', 'subdir'])
+            self.assertTrue(file_store.path_exists('object:kept.txt', 'grp', 'kind', 'obj2'))
+
+    def test_compressed_object_files(self):
+        data = 'compressible text\n' * 5000
+        src = self.write_file('out.txt', data)
+        with override_settings(FILE_INBOX_DATA_ROOT=os.path.join(self.tmp_dir, 'inbox'),
+                               FILE_PERMANENT_DATA_ROOT=os.path.join(self.tmp_dir, 'perm'),
+                               FILE_COMPRESSION_RULES={'gz': ['txt']}):
+            file_store.insure_file_in_object_folder(src, file_store.FileStoreLocations.FILE_SYSTEM, 'grp', 'kind', 'obj')
+            path, compression = file_store.get_object_folder_stored_path('out.txt', 'grp', 'kind', 'obj')
+            self.assertEqual(compression, 'gz')
+            self.assertTrue(os.path.getsize(path) < len(data) / 10)
+            self.assertEqual(file_store.open_object_folder_file('out.txt', 'grp', 'kind', 'obj').read(), data)
+            self.assertTrue(file_store.path_exists('object:out.txt', 'grp', 'kind', 'obj'))
+            # the plain path isn't there so resolving it is an error rather than a path that can't be opened
+            self.assertFalse(os.path.exists(file_store.get_object_folder_file_path('out.txt', 'grp', 'kind', 'obj')))
+            self.assertRaises(IOError, file_store.resolve_signified_path, 'object:out.txt', 'grp', 'kind', 'obj')
+
+            open(file_store.get_inbox_file_path('in.txt', 'grp'), 'wb').write(data)
+            open(file_store.get_inbox_file_path('in.csv', 'grp'), 'wb').write(data)
+            results = file_store.ingest_inbox_files(['in.txt', 'in.csv'], 'grp', 'kind', 'obj')
+            self.assertEqual([x['error'] for x in results], [None, None])
+            self.assertEqual(file_store.get_object_folder_stored_path('in.csv', 'grp', 'kind', 'obj')[1], None)
+            self.assertEqual(file_store.paths_exist(['object:in.txt', 'object:in.csv', 'object:in.dat'], 'grp', 'kind', 'obj'),
+                             [True, True, False])
+            self.assertEqual(file_store.open_object_folder_file('in.txt', 'grp', 'kind', 'obj').read(), data)
+
+    def test_compressed_content_store(self):
+        data = 'compressible shared text\n' * 5000
+        src = self.write_file('big.txt', data)
+        with override_settings(FILE_INBOX_DATA_ROOT=os.path.join(self.tmp_dir, 'inbox'),
+                               FILE_PERMANENT_DATA_ROOT=os.path.join(self.tmp_dir, 'perm'),
+                               FILE_CONTENT_STORE_ROOT=os.path.join(self.tmp_dir, 'store'),
+                               FILE_COMPRESSION_RULES={'gz': ['txt']}):
+            file_store.insure_file_in_object_folder(src, file_store.FileStoreLocations.FILE_SYSTEM, 'grp', 'kind', 'obj1')
+            open(file_store.get_inbox_file_path('big.txt', 'grp'), 'wb').write(data)
+            results = file_store.ingest_inbox_files(['big.txt'], 'grp', 'kind', 'obj2')
+            self.assertEqual([x['error'] for x in results], [None])
+
+            p1, c1 = file_store.get_object_folder_stored_path('big.txt', 'grp', 'kind', 'obj1')
+            p2, c2 = file_store.get_object_folder_stored_path('big.txt', 'grp', 'kind', 'obj2')
+            self.assertEqual((c1, c2), ('gz', 'gz'))
+            self.assertTrue(os.path.samefile(p1, p2))
+            self.assertEqual(os.stat(p1).st_nlink, 3)
+            self.assertEqual(file_store.open_object_folder_file('big.txt', 'grp', 'kind', 'obj2').read(), data)
+
+            os.remove(p1)
+            os.remove(p2)
+            self.assertEqual(file_store.collect_content_store_garbage(min_age=0)[0], 1)
+
+    def test_temp_files(self):
+        with override_settings(FILE_TEMP_DATA_ROOT=os.path.join(self.tmp_dir, 'tmp'),
+                               FILE_TEMP_QUOTAS={'lab': 3000}):
+            paths = []
+            for idx in range(3):
+                with file_store.temp_file('tmp:f%d.dat' % idx, 'lab', size_hint=1000, keep=True) as path:
+                    open(path, 'wb').write('x' * 1000)
+                    os.utime(path, (1000 + idx, 1000 + idx))
+                    paths.append(path)
+            self.assertEqual(file_store.resolve_signified_path('tmp:f0.dat', 'lab'), paths[0])
+
+            # The oldest file makes room for the new one
+            with file_store.temp_file(None, 'lab', size_hint=1000) as path:
+                open(path, 'wb').write('y' * 1000)
+                self.assertEqual([os.path.exists(x) for x in paths], [False, True, True])
+                self.assertEqual(file_store.enforce_temp_quota('lab', reserve=5000), 2000)
+                self.assertTrue(os.path.exists(path))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual([x for x in os.listdir(os.path.dirname(path)) if x.startswith('.lock-')], [])
+
+            # files locked by someone else (another process say) are left alone
+            with file_store.temp_file('tmp:held.dat', 'lab', keep=True) as held:
+                open(held, 'wb').write('z' * 3000)
+                os.utime(held, (10, 10))
+                with file_store.temp_file('tmp:other.dat', 'lab', size_hint=1000) as path:
+                    self.assertTrue(os.path.exists(held))
+
+            outside = os.path.join(self.tmp_dir, 'important.csv')
+            open(outside, 'wb').write('keep me')
+            for bad in (outside, 'file:' + outside, '../important.csv', 'tmp:../important.csv', 'sub/x.dat'):
+                with self.assertRaises(ValueError):
+                    with file_store.temp_file(bad, 'lab'):
+                        pass
+            self.assertRaises(ValueError, file_store.resolve_signified_path, 'tmp:../important.csv', 'lab')
+            self.assertTrue(os.path.exists(outside))
+
+    @unittest.skipIf(boto3 is None, "Needs boto3 and moto")
+    def test_s3_store(self):
+        import s3_store
+        saved_environ = os.environ.copy()
+        self.addCleanup(os.environ.update, saved_environ)
+        self.addCleanup(os.environ.clear)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        with mock_s3():
+            with override_settings(FILE_PERMANENT_DATA_ROOT=os.path.join(self.tmp_dir, 'perm'),
+                                   FILE_S3_BUCKET='test-bucket'):
+                s3_store._s3_client = None
+                s3_store.get_s3_client().create_bucket(Bucket='test-bucket')
+                data = 'cold data ' * 1000
+                open(file_store.get_object_folder_file_path('cold.txt', 'grp', 'kind', 'obj'), 'wb').write(data)
+
+                keys = s3_store.upload_object_folder_to_s3('grp', 'kind', 'obj', remove_local=True)
+                self.assertEqual(keys, ['grp/kind/obj/cold.txt'])
+                self.assertEqual(file_store.paths_exist(['s3:cold.txt', 's3:hot.txt', 'object:cold.txt'], 'grp', 'kind', 'obj'),
+                                 [True, False, False])
+                self.assertTrue(file_store.path_exists('s3:cold.txt', 'grp', 'kind', 'obj'))
+                self.assertEqual(s3_store.open_s3_file(keys[0], 5, 8).read(), 'data')
+                self.assertEqual(''.join(s3_store.read_s3_file_in_chunks(keys[0], 999)), data)
+
+                # Bring it back through the local cache
+                file_store.insure_file_in_object_folder('cold.txt', file_store.FileStoreLocations.CLOUD_STORAGE_S3,
+                                                        'grp', 'kind', 'obj')
+                self.assertTrue(file_store.path_exists('object:cold.txt', 'grp', 'kind', 'obj'))
+                self.assertTrue(os.path.exists(s3_store.get_s3_cache_path(keys[0])))
+
+                # Changed by someone else (so our cached copy wasn't dropped) is noticed by its ETag
+                s3_store.get_s3_client().put_object(Bucket='test-bucket', Key=keys[0], Body='new data')
+                self.assertEqual(open(s3_store.get_s3_file_local_path(keys[0]), 'rb').read(), 'cold data ' * 1000)
+                with override_settings(FILE_S3_CACHE_CHECK_SECONDS=0):
+                    self.assertEqual(open(s3_store.get_s3_file_local_path(keys[0]), 'rb').read(), 'new data')
+
+                # Over the quota the least recently used copies go
+                s3_store.get_s3_client().put_object(Bucket='test-bucket', Key='grp/kind/obj/other.txt', Body=data)
+                with override_settings(FILE_S3_CACHE_QUOTA=len(data) + 4):
+                    os.utime(s3_store.get_s3_cache_path(keys[0]), (1000, 1000))
+                    s3_store.get_s3_file_local_path('grp/kind/obj/other.txt')
+                    self.assertFalse(os.path.exists(s3_store.get_s3_cache_path(keys[0])))
+                    self.assertTrue(os.path.exists(s3_store.get_s3_cache_path('grp/kind/obj/other.txt')))
+
+                    # but not ones just used, even over the quota
+                    s3_store.get_s3_file_local_path(keys[0])
+                    self.assertTrue(os.path.exists(s3_store.get_s3_cache_path('grp/kind/obj/other.txt')))
+                s3_store._s3_client = None
+
+
+class TestSyncedThing(models.Model):
+    code = models.CharField(max_length=20)
+    region = models.IntegerField()
+    name = models.CharField(max_length=50)
+    size = models.IntegerField(default=0)
+    changed_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('code', 'region')
+
+
+class UtilsTest(TestCase):
+
+    def test_bulk_get_or_create_or_update(self):
+        rows = [dict(code="c%d" % x, region=x % 2, name="Thing %d" % x, size=x) for x in range(700)]
+        counts = bulk_get_or_create_or_update(TestSyncedThing, ['code', 'region'], rows)
+        self.assertEqual(counts, dict(created=700, updated=0, unchanged=0))
+        self.assertEqual(TestSyncedThing.objects.count(), 700)
+
+        before = TestSyncedThing.objects.get(code="c5").changed_on
+        for x in range(0, 700, 5):
+            rows[x]['size'] = -x - 1
+        rows.append(dict(code="c5", region=0, name="Other region"))
+        # a lookup and an update in each of the 3 batches, plus one insert and the savepoints
+        with self.assertNumQueries(3 * 4 + 1):
+            counts = bulk_get_or_create_or_update(TestSyncedThing, ['code', 'region'], rows)
+        self.assertEqual(counts, dict(created=1, updated=140, unchanged=560))
+
+        self.assertEqual(TestSyncedThing.objects.count(), 701)
+        thing = TestSyncedThing.objects.get(code="c5", region=1)
+        self.assertEqual((thing.name, thing.size), ("Thing 5", -6))
+        self.assertTrue(thing.changed_on > before)
+        self.assertEqual(TestSyncedThing.objects.get(code="c6").size, 6)
+        self.assertEqual(TestSyncedThing.objects.get(code="c5", region=0).name, "Other region")
+
+    def test_bulk_sync_concurrent_insert(self):
+        TestSyncedThing.objects.create(code="old", region=0, name="Old")
+        real_update = utils.update_model_from_dict
+
+        def update_and_insert(instance, d):
+            # as if another process inserted "new" after the lookup
+            if not TestSyncedThing.objects.filter(code="new").exists():
+                TestSyncedThing.objects.create(code="new", region=0, name="Theirs")
+            return real_update(instance, d)
+
+        utils.update_model_from_dict = update_and_insert
+        try:
+            counts = bulk_get_or_create_or_update(TestSyncedThing, ['code', 'region'],
+                                                  [dict(code="old", region=0, name="Old 2"),
+                                                   dict(code="new", region=0, name="Ours")])
+        finally:
+            utils.update_model_from_dict = real_update
+        self.assertEqual(counts, dict(created=0, updated=2, unchanged=0))
+        self.assertEqual(TestSyncedThing.objects.get(code="new").name, "Ours")
+        self.assertEqual(TestSyncedThing.objects.get(code="old").name, "Old 2")
+
+    def test_get_or_create_or_update(self):
+        thing, created, updated = get_or_create_or_update(TestSyncedThing, dict(code="a", region=1),
+                                                          dict(name="Big " * 10, size=1))
+        self.assertTrue(created)
+        self.assertEqual(updated, [])
+
+        with CaptureQueriesContext(connection) as queries:
+            thing, created, updated = get_or_create_or_update(TestSyncedThing, dict(code="a", region=1),
+                                                              dict(name="Big " * 10, size=2))
+        self.assertFalse(created)
+        self.assertEqual(updated, ['size'])
+        update_sql = [x['sql'] for x in queries.captured_queries if 'UPDATE' in x['sql']][0]
+        self.assertFalse('"name"' in update_sql)
+        self.assertTrue('"changed_on"' in update_sql)
+        self.assertEqual(TestSyncedThing.objects.get(code="a").size, 2)
+
+        self.assertEqual(get_or_create_or_update(TestSyncedThing, dict(code="a", region=1), dict(size=2))[2], [])
+
+    @override_settings(LOOKUP_CACHE_TIMEOUTS={'dj_extras.TestSyncedThing': 60})
+    def test_get_or_none_cached(self):
+        with self.assertRaises(AssertionError):
+            get_or_none_cached(ModelToAnnotate, foo=1)
+
+        # saves bump the generation whether or not this process has looked anything up
+        generation_key = "dj_extras.lookup_generation:dj_extras.TestSyncedThing"
+        get_lookup_cache().delete(generation_key)
+        thing = TestSyncedThing.objects.create(code="ref", region=1, name="Reference")
+        self.assertTrue(get_lookup_cache().get(generation_key))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref").name, "Reference")
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref").name, "Reference")
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref").pk, thing.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="none"), None)
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="none"), None)
+
+        thing.name = "Changed"
+        thing.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref").name, "Changed")
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref").name, "Changed")
+
+        start_lookup_memo()
+        try:
+            first = get_or_none_cached(TestSyncedThing, code="ref")
+            self.assertIs(get_or_none_cached(TestSyncedThing, code="ref"), first)
+            TestSyncedThing.objects.filter(pk=thing.pk).delete()
+            self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref"), None)
+        finally:
+            end_lookup_memo()
+
+        # bulk syncs don't send signals but still make the cached lookups stale
+        self.assertEqual(get_or_none_cached(TestSyncedThing, code="bulk"), None)
+        bulk_get_or_create_or_update(TestSyncedThing, ['code', 'region'], [dict(code="bulk", region=1, name="Bulk")])
+        self.assertEqual(get_or_none_cached(TestSyncedThing, code="bulk").name, "Bulk")
+        bulk_get_or_create_or_update(TestSyncedThing, ['code', 'region'], [dict(code="bulk", region=1, name="Bulk 2")])
+        self.assertEqual(get_or_none_cached(TestSyncedThing, code="bulk").name, "Bulk 2")
+
+
+class CachedLookupTransactionTest(TransactionTestCase):
+
+    @override_settings(LOOKUP_CACHE_TIMEOUTS={'dj_extras.TestSyncedThing': 60})
+    def test_invalidated_again_after_commit(self):
+        generation_key = "dj_extras.lookup_generation:dj_extras.TestSyncedThing"
+        with transaction.atomic():
+            TestSyncedThing.objects.create(code="ref", region=1, name="Reference")
+            # other processes could cache what they see under this generation until the commit
+            generation = get_lookup_cache().get(generation_key)
+            self.assertTrue(generation)
+        self.assertEqual(get_or_none_cached(TestSyncedThing, code="ref").name, "Reference")
+        self.assertNotEqual(get_lookup_cache().get(generation_key), generation)
+
+
+class OrmDumpTest(TestCase):
+    fixtures = ['users.json']
+
+    def snapshot(self):
+        return dict(things=[(x.pk, x.label, x.base.foo) for x in TestViewedThing.objects.order_by('pk')],
+                    items=list(TestViewedItem.objects.order_by('pk').values_list('pk', '_item_subclass', 'label')),
+                    uuids=[(x.char_id, x.binary_id) for x in TestUUIDModel.objects.order_by('pk')],
+                    notes=list(TestNote.objects.order_by('pk').values_list('note_txt', 'changed_by', 'created_on')),
+                    synced=list(TestSyncedThing.objects.order_by('pk').values_list('code', 'name', 'size')))
+
+    def test_dump_and_load(self):
+        u = User.objects.all()[0]
+        bo = ModelToAnnotate.objects.create(foo=7)
+        for idx in range(5):
+            TestViewedThing.objects.create(label="t%d" % idx, base=bo)
+            TestViewedItem.objects.create(label="i%d" % idx)
+            TestUUIDModel.objects.create()
+            TestNote.objects.create(base=bo, note_txt=u"Note \u2603 %d" % idx, created_by=u, changed_by=u)
+        bulk_get_or_create_or_update(TestSyncedThing, ['code'], [dict(code="c%d" % x, region=0, name="n", size=x)
+                                                                   for x in range(25)])
+        before = self.snapshot()
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'data.jsonl.gz')
+            rval = dump_app_data('dj_extras', path, chunk_size=4)
+            self.assertEqual(rval['error'], None)
+            self.assertEqual(rval['counts']['dj_extras.TestSyncedThing'], 25)
+            self.assertEqual(rval['counts']['dj_extras.TestViewedThing'], 5)
+
+            rval = load_app_data('dj_extras', path, batch_size=3, clear=True)
+            self.assertEqual(rval['error'], None)
+            self.assertEqual(rval['counts']['dj_extras.TestViewedItem'], 10)
+            self.assertEqual(self.snapshot(), before)
+
+            TestSyncedThing.objects.create(code="new", region=0, name="after")
+            self.assertEqual(TestSyncedThing.objects.count(), 26)
+
+            # a bad dump part way through leaves everything as it was
+            f = gzip.open(path, 'ab')
+            f.write('{"model": "dj_extras.NoSuchModel", "fields": ["id"]}\n[1]\n')
+            f.close()
+            rval = load_app_data('dj_extras', path, clear=True)
+            self.assertTrue('NoSuchModel' in rval['error'])
+            self.assertEqual(TestSyncedThing.objects.count(), 26)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class FormClassTest(TestCase):
+
+    def test_cached_form_classes(self):
+        params = [dict(name='count', kind=ParameterTypes.INTEGER),
+                  dict(name='mode', kind=ParameterTypes.ENUM, choices=[('a', 'A'), ('b', 'B')])]
+        form_class = create_form_class_with_parameter_list(params)
+        self.assertIs(create_form_class_with_parameter_list([dict(x) for x in params]), form_class)
+        self.assertIsNot(create_form_class_with_parameter_list(params[:1]), form_class)
+
+        # each form still gets its own fields
+        f1 = form_class()
+        f2 = form_class(initial=dict(count=3))
+        f1.fields['mode'].choices = [('c', 'C')]
+        self.assertEqual(list(f2.fields['mode'].choices), [('a', 'A'), ('b', 'B')])
+        self.assertEqual(sorted(f2.fields.keys()), ['count', 'mode'])
+
+        model_form = get_form_class_for_class(ModelToAnnotate)
+        self.assertIs(get_form_class_for_class(ModelToAnnotate), model_form)
+        self.assertTrue(model_form(data=dict(foo=5)).is_valid())
+
 
 class MyTest(TestCase):
     def no_crazy_talk(self):
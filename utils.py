@@ -1,5 +1,16 @@
 
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import models, connections, router, transaction, IntegrityError
+from django.db.models import signals
+from django.test.signals import setting_changed
+
+from collections import OrderedDict
+import hashlib
+import threading
+import uuid
 
 def get_or_none(model, **kwargs):
     """
@@ -11,40 +22,383 @@ def get_or_none(model, **kwargs):
         return None
 
 
+#
+# Cached lookups for small reference models that hardly ever change. Values are kept in the cache named by
+# settings.LOOKUP_CACHE_ALIAS ('default', which is local memory unless CACHES says otherwise) for the model's
+# timeout: its lookup_cache_timeout attribute, else settings.LOOKUP_CACHE_TIMEOUTS['app_label.ModelName'],
+# else LOOKUP_CACHE_TIMEOUT. Saving or deleting any row of a model changes the model's generation in the cache
+# which makes all its cached lookups stale. With LookupMemoMiddleware lookups are also memoized for the request.
+#
+# Models have to be marked as cached (with the cache_lookups decorator, a lookup_cache_timeout attribute
+# or an entry in LOOKUP_CACHE_TIMEOUTS) so every process knows to bump the generation when it saves one,
+# even if it never looks anything up itself. That only reaches other processes if the cache is shared,
+# with the default local memory cache they only see changes when their entries time out.
+#
+# A change made in a transaction is invalidated straight away and again once the transaction is over,
+# in case a reader cached the old row before the commit. Django has no commit hook so "once it's over"
+# is the next lookup, save or request end in the same thread.
+#
+LOOKUP_CACHE_TIMEOUT = 300
+LOOKUP_CACHE_MISSING = '$$MISSING$$'
+
+_lookup_memo = threading.local()
+_lookup_pending = threading.local()
+_lookup_cached_models = set()
+
+
+def _get_model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+
+def cache_lookups(model):
+    """
+    Class decorator marking a model as one get_or_none_cached can be used with
+    """
+    _lookup_cached_models.add(model)
+    _watch_model(model)
+    return model
+
+
+def is_lookup_cached(model):
+    return (model in _lookup_cached_models or getattr(model, 'lookup_cache_timeout', None) is not None or
+            _get_model_label(model) in getattr(settings, 'LOOKUP_CACHE_TIMEOUTS', {}))
+
+
+def get_lookup_cache():
+    return caches[getattr(settings, 'LOOKUP_CACHE_ALIAS', 'default')]
+
+
+def get_lookup_cache_timeout(model):
+    timeout = getattr(model, 'lookup_cache_timeout', None)
+    if timeout is None:
+        timeout = getattr(settings, 'LOOKUP_CACHE_TIMEOUTS', {}).get(_get_model_label(model))
+    if timeout is None:
+        timeout = getattr(settings, 'LOOKUP_CACHE_TIMEOUT', LOOKUP_CACHE_TIMEOUT)
+    return timeout
+
+
+def start_lookup_memo():
+    _lookup_memo.models = {}
+
+
+def end_lookup_memo():
+    _lookup_memo.models = None
+
+
+def _get_memo(model):
+    models_memo = getattr(_lookup_memo, 'models', None)
+    if models_memo is None:
+        return None
+    return models_memo.setdefault(_get_model_label(model), {})
+
+
+def _get_generation_key(model):
+    return "dj_extras.lookup_generation:%s" % _get_model_label(model)
+
+
+def invalidate_cached_lookups(model):
+    """
+    Forget all the cached lookups for model. Called on post_save and post_delete of cached models
+    """
+    get_lookup_cache().set(_get_generation_key(model), uuid.uuid4().hex, None)
+    models_memo = getattr(_lookup_memo, 'models', None)
+    if models_memo:
+        models_memo.pop(_get_model_label(model), None)
+
+
+def _invalidate_after_change(model, using):
+    invalidate_pending_lookups()
+    invalidate_cached_lookups(model)
+    if connections[using].in_atomic_block:
+        if getattr(_lookup_pending, 'models', None) is None:
+            _lookup_pending.models = set()
+        _lookup_pending.models.add((using, model))
+
+
+def invalidate_pending_lookups(**kwargs):
+    """
+    Invalidate again the cached lookups of models changed in transactions which have since finished
+    """
+    pending = getattr(_lookup_pending, 'models', None)
+    if not pending:
+        return
+    for using, model in list(pending):
+        if not connections[using].in_atomic_block:
+            pending.discard((using, model))
+            invalidate_cached_lookups(model)
+
+request_finished.connect(invalidate_pending_lookups, dispatch_uid="dj_extras.lookup_cache")
+
+
+def _invalidate_on_change(sender, using=None, **kwargs):
+    if is_lookup_cached(sender):
+        _invalidate_after_change(sender, using or router.db_for_write(sender))
+
+
+def _watch_model(model):
+    uid = "dj_extras.lookup_cache:%s" % _get_model_label(model)
+    signals.post_save.connect(_invalidate_on_change, sender=model, dispatch_uid=uid)
+    signals.post_delete.connect(_invalidate_on_change, sender=model, dispatch_uid=uid)
+
+
+def _watch_if_cached(sender, **kwargs):
+    if is_lookup_cached(sender):
+        _watch_model(sender)
+
+
+def _watch_cached_models(**kwargs):
+    if kwargs.get('setting', 'LOOKUP_CACHE_TIMEOUTS') != 'LOOKUP_CACHE_TIMEOUTS':
+        return
+    for app_models in apps.all_models.values():
+        for model in app_models.values():
+            _watch_if_cached(model)
+
+# the receivers are connected for each cached model as it is defined (or when this module loads,
+# models.py imports it) rather than on the first lookup
+signals.class_prepared.connect(_watch_if_cached, dispatch_uid="dj_extras.lookup_cache")
+setting_changed.connect(_watch_cached_models, dispatch_uid="dj_extras.lookup_cache")
+_watch_cached_models()
+
+
+def get_or_none_cached(model, **kwargs):
+    """
+    Like get_or_none but the result (including not finding anything) is cached. Only for models whose
+    rows are changed through the ORM (so the signals fire) and rarely. Within a request using the memo the
+    same instance is handed back each time so don't change it. The model has to be marked as cached.
+    """
+    assert is_lookup_cached(model), "%s isn't marked for cached lookups" % _get_model_label(model)
+    invalidate_pending_lookups()
+    memo = _get_memo(model)
+    lookup = tuple(sorted((k, v.pk if isinstance(v, models.Model) else v) for k, v in kwargs.items()))
+    if memo is not None and lookup in memo:
+        return memo[lookup]
+
+    cache = get_lookup_cache()
+    generation_key = _get_generation_key(model)
+    generation = cache.get(generation_key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(generation_key, generation, None):
+            generation = cache.get(generation_key, generation)
+
+    key = "dj_extras.lookup:%s:%s:%s" % (_get_model_label(model), generation,
+                                        hashlib.md5(repr(lookup)).hexdigest())
+    instance = cache.get(key)
+    if instance is None:
+        instance = get_or_none(model, **kwargs)
+        cache.set(key, LOOKUP_CACHE_MISSING if instance is None else instance, get_lookup_cache_timeout(model))
+    elif instance == LOOKUP_CACHE_MISSING:
+        instance = None
+
+    if memo is not None:
+        memo[lookup] = instance
+    return instance
+
+
+_model_fields = {}
+
+
+def get_model_fields(model_class):
+    """
+    A dict of field name to field for model_class, worked out once per model
+    """
+    fields = _model_fields.get(model_class)
+    if fields is None:
+        fields = _model_fields[model_class] = dict((x.name, x) for x in model_class._meta.fields)
+    return fields
+
+
+def get_auto_now_field_names(model_class):
+    return [name for name, field in get_model_fields(model_class).items() if getattr(field, 'auto_now', False)]
+
+
+def _get_changed_values(instance, d):
+    fields = get_model_fields(type(instance))
+    changed = {}
+    for name, value in d.items():
+        field = fields.get(name)
+        if field is None:
+            continue
+        if field.rel:
+            # compare the ids so we don't fetch the related row
+            old = getattr(instance, field.attname)
+            value_id = value.pk if isinstance(value, models.Model) else value
+            if old != value_id:
+                changed[name] = value
+        elif getattr(instance, name) != value:
+            changed[name] = value
+    return changed
+
+
 def update_model_from_dict(instance, d):
     """
     Update a model instance's fieled from the specified dictionary
-    This does not save the model
+    This does not save the model. Returns the list of the names of the fields that changed
+    (so it can be passed to save as update_fields), empty if nothing changed
     """
-    field_dict = dict((x.name, getattr(instance, x.name)) for x in instance._meta.fields)
-    changed = {}
-    for field in d:
-        if field in field_dict:
-            if getattr(instance, field) != d[field]:
-                changed[field] = d[field]
-
-    if changed:
-        for x in changed:
-            setattr(instance, x, changed[x])
-        return True
-    else:
-        return False
+    changed = _get_changed_values(instance, d)
+    for x in changed:
+        setattr(instance, x, changed[x])
+    return sorted(changed)
+
 
 def get_or_create_or_update(model_class, key_dict, values_dict):
     """
     If a model matching key_dict for model_class exists then update it with values dict
     If it doesn't exist then create it used the defaults from values dict
+    Returns the instance, whether it was created and the list of fields that were updated
     """
-    updated = False
+    updated = []
     key_dict['defaults'] = values_dict
     instance, created = model_class.objects.get_or_create(**key_dict)
     if not created:
         updated = update_model_from_dict(instance, values_dict)
         if updated:
-            instance.save()
+            instance.save(update_fields=updated + get_auto_now_field_names(model_class))
     return instance, created, updated
 
 
+BULK_UPSERT_BATCH_SIZE = 300
+
+
+def _get_key_value(field, value):
+    """
+    Key values from the caller and from the database in the same form so they compare equal
+    """
+    if isinstance(value, models.Model):
+        value = value.pk
+    target = field.rel.get_related_field() if field.rel else field
+    return target.to_python(value)
+
+
+def _get_case_placeholder(field, connection):
+    """
+    postgresql types a CASE by its THEN values so a batch of all NULLs (unknown) can't go in a
+    typed column without a cast. Other databases are left alone, their CAST types differ from column types.
+    """
+    db_type = field.db_type(connection=connection)
+    if connection.vendor == 'postgresql' and db_type:
+        return "CAST(%%s AS %s)" % db_type.replace('%', '%%')
+    return "%s"
+
+
+def bulk_update_model_fields(model_class, instances, field_names, using=None):
+    """
+    Save just field_names of the (already saved) instances with one UPDATE per batch of rows.
+    Fields with the same value for every instance are set once rather than per row.
+    """
+    if not instances or not field_names:
+        return
+    db = using or router.db_for_write(model_class)
+    connection = connections[db]
+    opts = model_class._meta
+    qn = connection.ops.quote_name
+    pk_column = qn(opts.pk.column)
+    fields = [opts.get_field(x) for x in field_names]
+    values = dict((field.name, [field.get_db_prep_save(getattr(x, field.attname), connection=connection)
+                                for x in instances]) for field in fields)
+    constant = [x for x in fields if all(v == values[x.name][0] for v in values[x.name])]
+    varying = [x for x in fields if x not in constant]
+    # each row takes a WHEN pk THEN value per varying field and its pk in the IN, the constants one each
+    batch_size = max(1, connection.ops.bulk_batch_size([opts.pk] + varying * 2, instances) - len(constant))
+
+    cursor = connection.cursor()
+    for idx in range(0, len(instances), batch_size):
+        batch = instances[idx:idx + batch_size]
+        sets = []
+        params = []
+        for field in varying:
+            when = "WHEN %%s THEN %s" % _get_case_placeholder(field, connection)
+            sets.append("%s = CASE %s %s END" % (qn(field.column), pk_column, " ".join([when] * len(batch))))
+            for offset, instance in enumerate(batch):
+                params.extend([instance.pk, values[field.name][idx + offset]])
+        for field in constant:
+            sets.append("%s = %%s" % qn(field.column))
+            params.append(values[field.name][0])
+        params.extend([x.pk for x in batch])
+        cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (qn(opts.db_table), ", ".join(sets), pk_column,
+                                                             ", ".join(["%s"] * len(batch))), params)
+
+    # no save signals are sent so cached lookups have to be told
+    if is_lookup_cached(model_class):
+        _invalidate_after_change(model_class, db)
+
+
+def bulk_get_or_create_or_update(model_class, key_fields, values_dicts, batch_size=BULK_UPSERT_BATCH_SIZE):
+    """
+    get_or_create_or_update for lots of rows. Each dict in values_dicts has the key_fields and the values to set.
+    Rows are looked up a batch at a time, the missing ones are made with bulk_create and the changed ones
+    have just their changed fields written. A batch is looked up and written again if another process
+    inserted some of the same keys in between (and they are unique). Returns a dict of the created,
+    updated and unchanged counts.
+    """
+    opts = model_class._meta
+    key_fields = [opts.get_field(x) for x in key_fields]
+    auto_now_field_names = get_auto_now_field_names(model_class)
+    db = router.db_for_write(model_class)
+    counts = dict(created=0, updated=0, unchanged=0)
+
+    def make_key(get_value):
+        return tuple(_get_key_value(field, get_value(field)) for field in key_fields)
+
+    def sync_batch(by_key):
+        # a superset of the rows we want, narrowed down by matching the whole key below
+        lookups = dict(("%s__in" % field.name, set(key[idx] for key in by_key)) for idx, field in enumerate(key_fields))
+        existing = {}
+        for instance in model_class.objects.using(db).filter(**lookups):
+            existing[make_key(lambda field: getattr(instance, field.attname))] = instance
+
+        to_create = []
+        to_update = {}
+        unchanged = 0
+        for key, d in by_key.items():
+            instance = existing.get(key)
+            if instance is None:
+                to_create.append(model_class(**d))
+                continue
+            changed = update_model_from_dict(instance, d)
+            if not changed:
+                unchanged += 1
+                continue
+            for name in auto_now_field_names:
+                opts.get_field(name).pre_save(instance, False)
+            to_update.setdefault(tuple(sorted(set(changed + auto_now_field_names))), []).append(instance)
+
+        with transaction.atomic(using=db):
+            if to_create:
+                model_class.objects.using(db).bulk_create(to_create)
+            for field_names, instances in to_update.items():
+                bulk_update_model_fields(model_class, instances, field_names, using=db)
+        return dict(created=len(to_create), updated=sum(len(x) for x in to_update.values()), unchanged=unchanged)
+
+    def sync_keys(batch):
+        by_key = OrderedDict()
+        for d in batch:
+            by_key.setdefault(make_key(lambda field: d[field.name]), {}).update(d)
+        try:
+            batch_counts = sync_batch(by_key)
+        except IntegrityError:
+            # someone else created some of the rows since we looked (there is no ON CONFLICT in 1.7)
+            # so look again, this time they get updated
+            batch_counts = sync_batch(by_key)
+        for name, count in batch_counts.items():
+            counts[name] += count
+
+    batch = []
+    for d in values_dicts:
+        batch.append(d)
+        if len(batch) >= batch_size:
+            sync_keys(batch)
+            batch = []
+    if batch:
+        sync_keys(batch)
+
+    # bulk_create doesn't send post_save either
+    if counts['created'] and is_lookup_cached(model_class):
+        _invalidate_after_change(model_class, db)
+    return counts
+
+
 def get_array_from_raw(name, raw):
     """
     For parsing out jquery array ajax stuff